@@ -0,0 +1,551 @@
+"""
+Benchmarks: load tests of every route, worker cold starts and micro-benchmarks, results as JSON
+
+    $ python benchmarks.py run --out before.json
+    $ python benchmarks.py compare before.json after.json
+    $ python benchmarks.py revisions main HEAD
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BENCH_PASSWORD = "benchmark"
+NAMES = ["Luke", "Leia", "Han", "Anakin", "Padme", "Obi-Wan", "Yoda", "Boba", "Lando", "Rey", "Finn", "Poe"]
+# the routes that are run with --slow-requests, /token hashes a password per request
+SLOW_ROUTES = {("POST", "/token")}
+# GETs first so the writes don't change what the reads see, always in the same order
+METHOD_ORDER = {"GET": 0, "POST": 1, "PUT": 2, "PATCH": 3, "DELETE": 4}
+URL_ARGUMENT = re.compile(r"<(?:([^:<>]+):)?([^<>]+)>")
+
+
+def percentile(sorted_values, percent):
+    # nearest rank
+    if not sorted_values:
+        return None
+    rank = max(int(round(percent / 100.0 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def summarize(latencies, statuses, errors, elapsed):
+    latencies = sorted(latencies)
+    result = {
+        "requests": len(latencies),
+        "errors": errors,
+        "status": {str(status): statuses.count(status) for status in sorted(set(statuses))},
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+    }
+    for percent in (50, 95, 99):
+        value = percentile(latencies, percent)
+        result["p%d_ms" % percent] = round(value * 1000, 3) if value is not None else None
+    result["mean_ms"] = round(statistics.mean(latencies) * 1000, 3) if latencies else None
+    return result
+
+
+def revision(app_dir):
+    def git(*args):
+        return subprocess.run(
+            ["git", "-C", app_dir] + list(args), capture_output=True, text=True,
+        ).stdout.strip()
+    return {"commit": git("rev-parse", "HEAD") or None, "dirty": bool(git("status", "--porcelain", "--", "."))}
+
+
+# ****************SEED********************
+# ----------------------------------------
+
+
+def seed(db, models, volumes, rng):
+    # Drops and creates every table, then inserts `volumes` rows. Only the columns
+    # that exist since the first revision are set so older revisions can be seeded.
+    db.drop_all()
+    db.create_all()
+    rows = {
+        "People": lambda i: models.People(
+            name="%s People %d" % (rng.choice(NAMES), i), gender=rng.choice(["male", "female", "n/a"]),
+            skin_color="fair", birth=rng.choice(["%dBBY" % rng.randint(1, 900), "%dABY" % rng.randint(1, 40), "unknown"]),
+            eyes_color=rng.choice(["blue", "brown", "yellow"]),
+        ),
+        "Planets": lambda i: models.Planets(
+            name="%s Planet %d" % (rng.choice(NAMES), i), diameter=str(rng.randint(1000, 200000)),
+            climate=rng.choice(["arid", "temperate", "frozen"]),
+            population=rng.choice([str(rng.randint(1000, 10 ** 12)), "unknown"]), gravity="1 standard",
+        ),
+        "Vehicles": lambda i: models.Vehicles(
+            name="%s Vehicle %d" % (rng.choice(NAMES), i), crafter="Incom", tripulation=str(rng.randint(1, 5)),
+            speed=str(rng.randint(100, 2000)), passengers=str(rng.randint(0, 100)),
+        ),
+    }
+    for name, make in rows.items():
+        for start in range(0, volumes[name.lower()], 1000):
+            db.session.add_all([make(i) for i in range(start + 1, min(start + 1000, volumes[name.lower()]) + 1)])
+            db.session.commit()
+
+    # hashed once for every user when the revision hashes passwords, plain text otherwise
+    try:
+        from passwords import hash_password
+        password = hash_password(BENCH_PASSWORD)
+    except ImportError:
+        password = BENCH_PASSWORD
+    for start in range(0, volumes["users"], 1000):
+        db.session.add_all([
+            models.User(email="user%d@example.com" % i, password=password, name="User %d" % i, is_active=True)
+            for i in range(start + 1, min(start + 1000, volumes["users"]) + 1)
+        ])
+        db.session.commit()
+
+    favorites = [
+        (models.Favorites_people, "people_id", volumes["people"]),
+        (models.Favorites_planet, "planet_id", volumes["planets"]),
+        (models.Favorites_vehicles, "vehicles_id", volumes["vehicles"]),
+    ]
+    for user_id in range(1, volumes["users"] + 1):
+        for favorite, foreign_key, total in favorites:
+            for item_id in rng.sample(range(1, total + 1), min(volumes["favorites"], total)):
+                db.session.add(favorite(**{"user_id": user_id, foreign_key: item_id}))
+        db.session.commit()
+
+
+# ****************REQUESTS********************
+# --------------------------------------------
+
+
+class Requests:
+    # Builds the requests for a route: the url arguments are picked at random
+    # (with a fixed seed) among the seeded ids, the benchmark user is user 1.
+
+    def __init__(self, app, volumes, rng):
+        self.app = app
+        self.volumes = volumes
+        self.rng = rng
+        self.email = "user1@example.com"
+
+    def token(self):
+        from flask_jwt_extended import create_access_token
+        with self.app.app_context():
+            return create_access_token(identity=self.email)
+
+    def ids(self, argument, count):
+        total = self.volumes["people"]
+        if argument.startswith("planet"):
+            total = self.volumes["planets"]
+        elif argument.startswith("vehicle"):
+            total = self.volumes["vehicles"]
+        # distinct while there are enough, so a DELETE doesn't remove the same favorite twice
+        ids = self.rng.sample(range(1, total + 1), min(count, total))
+        return [ids[position % len(ids)] for position in range(count)]
+
+    def build(self, rule, method, count):
+        # -> (requests, prepare): prepare is run before the timed requests
+        headers = {"Authorization": "Bearer " + self.token()}
+        values = {}
+        for converter, argument in URL_ARGUMENT.findall(rule.rule):
+            if converter.startswith("any("):
+                choices = [choice.strip() for choice in converter[len("any("):-1].split(",")]
+                values[argument] = [self.rng.choice(choices) for _ in range(count)]
+            elif argument == "user_id":
+                values[argument] = [1] * count
+            else:
+                values[argument] = self.ids(argument, count)
+        paths = [URL_ARGUMENT.sub(lambda match: str(values[match.group(2)][position]), rule.rule) for position in range(count)]
+        if rule.rule == "/search":
+            paths = ["/search?q=%s" % self.rng.choice(NAMES) for _ in paths]
+        if rule.rule == "/changes":
+            # a client a few versions behind, the usual incremental sync
+            from changes import current_version
+            from models import db
+            with self.app.app_context():
+                latest = current_version(db.session)
+            paths = ["/changes?since=%d" % max(0, latest - self.rng.randint(1, 10)) for _ in paths]
+
+        requests, prepare = [], []
+        for path in paths:
+            body = None
+            request_headers = headers
+            if rule.rule == "/token" and method == "POST":
+                body = {"email": self.email, "password": BENCH_PASSWORD}
+            elif rule.rule == "/token" and method == "DELETE":
+                # revoking makes a token useless, one each
+                request_headers = {"Authorization": "Bearer " + self.token()}
+            elif rule.rule.endswith("/batch"):
+                body = [
+                    {"kind": kind, "id": self.ids(kind, 1)[0], "op": self.rng.choice(["add", "remove"])}
+                    for kind in self.rng.choices(["people", "planets", "vehicles"], k=10)
+                ]
+            elif method == "DELETE" and "favorites" in rule.rule:
+                # the favorite has to exist to measure a real delete
+                prepare.append(("POST", path, headers, None))
+            requests.append((method, path, request_headers, body))
+        return requests, prepare
+
+
+def routes(app):
+    result = []
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint == "static" or rule.rule.startswith("/admin"):
+            continue
+        for method in sorted(rule.methods - {"HEAD", "OPTIONS"}):
+            result.append((rule, method))
+    return sorted(result, key=lambda item: (METHOD_ORDER.get(item[1], 9), item[0].rule))
+
+
+class TestClient:
+    concurrency = 1
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def send(self, method, path, headers, body):
+        response = self.client.open(path, method=method, headers=headers, json=body)
+        response.get_data()
+        return response.status_code
+
+
+class HttpClient:
+    def __init__(self, port, concurrency):
+        self.port = port
+        self.concurrency = concurrency
+
+    def send(self, method, path, headers, body):
+        # a connection per request, like clients that don't keep them alive
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+        try:
+            headers = dict(headers)
+            payload = None
+            if body is not None:
+                payload = json.dumps(body).encode("utf-8")
+                headers["Content-Type"] = "application/json"
+            connection.request(method, path, body=payload, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        finally:
+            connection.close()
+
+
+def drive(client, requests):
+    latencies, statuses = [], []
+    errors = 0
+
+    def timed(request):
+        started_at = time.perf_counter()
+        try:
+            status = client.send(*request)
+        except Exception:
+            status = None
+        return time.perf_counter() - started_at, status
+
+    started_at = time.perf_counter()
+    if client.concurrency > 1:
+        with ThreadPoolExecutor(client.concurrency) as executor:
+            results = list(executor.map(timed, requests))
+    else:
+        results = [timed(request) for request in requests]
+    elapsed = time.perf_counter() - started_at
+
+    for latency, status in results:
+        if status is None or status >= 500:
+            errors += 1
+        if status is not None:
+            statuses.append(status)
+        latencies.append(latency)
+    return summarize(latencies, statuses, errors, elapsed)
+
+
+def load_test(app, client, volumes, options):
+    results = {}
+    rng = random.Random(options.seed)
+    builder = Requests(app, volumes, rng)
+    for rule, method in routes(app):
+        count = options.slow_requests if (method, rule.rule) in SLOW_ROUTES else options.requests
+        requests, prepare = builder.build(rule, method, options.warmup + count)
+        for request in prepare:
+            client.send(*request)
+        for request in requests[:options.warmup]:
+            client.send(*request)
+        results["%s %s" % (method, rule.rule)] = drive(client, requests[options.warmup:])
+    return results
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+PROCFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Procfile")
+SHELL_DEFAULT = re.compile(r"\$\{(\w+):-([^}]*)\}")
+
+
+def procfile_worker_options(path=PROCFILE, environ=os.environ):
+    # the worker class and threads of the Procfile's web process, so the load
+    # test runs the production configuration -> ["--worker-class", "gthread", ...]
+    with open(path) as file:
+        web = next((line.split(":", 1)[1] for line in file if line.startswith("web:")), "")
+    web = SHELL_DEFAULT.sub(lambda match: environ.get(match.group(1)) or match.group(2), web)
+    words, options = web.split(), []
+    for position, word in enumerate(words[:-1]):
+        if word in ("-k", "--worker-class", "--threads"):
+            options += ["--threads" if word == "--threads" else "--worker-class", words[position + 1]]
+    return options
+
+
+def start_gunicorn(app_dir, environ, workers, worker_options=()):
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "wsgi", "--chdir", app_dir, "--bind", "127.0.0.1:%d" % port,
+         "--workers", str(workers), *worker_options, "--log-level", "warning"],
+        env=environ,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("gunicorn exited with code %s" % process.returncode)
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process, port
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("gunicorn didn't start listening on port %d" % port)
+
+
+# ****************STARTUP********************
+# ----------------------------------------------
+
+COLD_START = "import time; started_at = time.perf_counter(); import main; print(time.perf_counter() - started_at)"
+
+
+def cold_start(app_dir, environ, runs):
+    # seconds to `import main` (what a worker does on boot) in fresh interpreters
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-W", "ignore", "-c", COLD_START], cwd=app_dir, env=environ,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True, universal_newlines=True,
+        ).stdout
+        timings.append(float(output.split()[-1]) * 1000)
+    timings.sort()
+    return {
+        "runs": runs,
+        "min_ms": round(timings[0], 1),
+        "median_ms": round(statistics.median(timings), 1),
+        "max_ms": round(timings[-1], 1),
+    }
+
+
+# ****************MICRO********************
+# -----------------------------------------
+
+
+def micro(callable_, repeat=5):
+    # per call timings in microseconds, over as many calls as fit in ~0.2s
+    timer = timeit.Timer(callable_)
+    number, _ = timer.autorange()
+    timings = [total / number * 1e6 for total in timer.repeat(repeat=repeat, number=number)]
+    return {"calls": number, "min_us": round(min(timings), 3), "median_us": round(statistics.median(timings), 3)}
+
+
+def micro_benchmarks(app, models, generate_sitemap):
+    from flask import jsonify
+    results = {}
+    with app.app_context():
+        for model in (models.People, models.Planets, models.Vehicles, models.User, models.Favorites_people):
+            item = model.query.first()
+            if item is not None:
+                results["serialize %s" % model.__name__] = micro(item.serialize)
+        page = [item.serialize() for item in models.People.query.limit(50).all()]
+        with app.test_request_context("/"):
+            results["jsonify 1 item"] = micro(lambda: jsonify(page[0]))
+            results["jsonify %d items" % len(page)] = micro(lambda: jsonify(page))
+            results["generate_sitemap"] = micro(lambda: generate_sitemap(app))
+    return results
+
+
+# ****************COMMANDS********************
+# --------------------------------------------
+
+
+def run(options):
+    app_dir = os.path.abspath(options.app_dir)
+    work_dir = tempfile.mkdtemp(prefix="benchmarks-")
+    database_url = options.db or "sqlite:///" + os.path.join(work_dir, "benchmarks.db")
+    os.environ["DB_CONNECTION_STRING"] = database_url
+    # every request comes from the same client, the rate limits would turn most into 429s
+    os.environ.setdefault("RATE_LIMIT_TOKEN_RATE", "0")
+    os.environ.setdefault("RATE_LIMIT_LIST_RATE", "0")
+    sys.path.insert(0, app_dir)
+    try:
+        import main
+        import models
+        from utils import generate_sitemap
+
+        volumes = {
+            "people": options.people, "planets": options.planets, "vehicles": options.vehicles,
+            "users": options.users, "favorites": options.favorites,
+        }
+        started_at = time.perf_counter()
+        with main.app.app_context():
+            seed(models.db, models, volumes, random.Random(options.seed))
+        seed_seconds = time.perf_counter() - started_at
+
+        result = {
+            "revision": revision(app_dir),
+            "python": platform.python_version(),
+            "database": database_url.split(":", 1)[0],
+            "volumes": volumes,
+            "seed_seconds": round(seed_seconds, 3),
+            "settings": {
+                "requests": options.requests, "slow_requests": options.slow_requests, "warmup": options.warmup,
+                "seed": options.seed, "workers": options.workers, "concurrency": options.concurrency,
+            },
+            "load": {},
+        }
+        if options.startup_runs:
+            result["startup"] = cold_start(app_dir, dict(os.environ), options.startup_runs)
+        if options.mode in ("client", "both"):
+            result["load"]["client"] = load_test(main.app, TestClient(main.app), volumes, options)
+        if options.mode in ("gunicorn", "both"):
+            # the database is seeded again so both modes start from the same rows
+            with main.app.app_context():
+                seed(models.db, models, volumes, random.Random(options.seed))
+                models.db.engine.dispose()
+            worker_options = procfile_worker_options()
+            result["settings"]["gunicorn"] = " ".join(worker_options)
+            process, port = start_gunicorn(app_dir, dict(os.environ), options.workers, worker_options)
+            try:
+                result["load"]["gunicorn"] = load_test(main.app, HttpClient(port, options.concurrency), volumes, options)
+            finally:
+                process.terminate()
+                process.wait()
+        if not options.skip_micro:
+            result["micro"] = micro_benchmarks(main.app, models, generate_sitemap)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if options.out:
+        with open(options.out, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+
+def change(before, after):
+    if before is None or after is None:
+        return ""
+    if not before:
+        return "n/a"
+    return "%+.1f%%" % ((after - before) / before * 100)
+
+
+def compare(options):
+    with open(options.before) as file:
+        before = json.load(file)
+    with open(options.after) as file:
+        after = json.load(file)
+    print("before: %s  after: %s" % (before["revision"]["commit"], after["revision"]["commit"]))
+    row = "%-62s %10s %10s %9s"
+    for mode in sorted(set(before["load"]) & set(after["load"])):
+        print("\n[%s]" % mode)
+        for metric in ("p50_ms", "p95_ms", "p99_ms", "throughput_rps"):
+            print(row % (metric, "before", "after", "change"))
+            for route in sorted(set(before["load"][mode]) & set(after["load"][mode])):
+                old, new = before["load"][mode][route][metric], after["load"][mode][route][metric]
+                print(row % (route, old, new, change(old, new)))
+        only = set(before["load"][mode]) ^ set(after["load"][mode])
+        if only:
+            print("only in one of the runs: %s" % ", ".join(sorted(only)))
+    if "startup" in before and "startup" in after:
+        print("\n[startup]")
+        print(row % ("import main", "before", "after", "change"))
+        for metric in ("min_ms", "median_ms", "max_ms"):
+            old, new = before["startup"][metric], after["startup"][metric]
+            print(row % (metric, old, new, change(old, new)))
+    if "micro" in before and "micro" in after:
+        print("\n[micro]")
+        print(row % ("median_us", "before", "after", "change"))
+        for name in sorted(set(before["micro"]) & set(after["micro"])):
+            old, new = before["micro"][name]["median_us"], after["micro"][name]["median_us"]
+            print(row % (name, old, new, change(old, new)))
+
+
+def revisions(options, run_arguments):
+    # Checks every revision out in a temporary git worktree and runs this file
+    # (the current one) against its src/, so old revisions can be measured too.
+    out_dir = options.out_dir or tempfile.mkdtemp(prefix="benchmarks-")
+    os.makedirs(out_dir, exist_ok=True)
+    outputs = []
+    for name in (options.before, options.after):
+        worktree = tempfile.mkdtemp(prefix="benchmarks-worktree-")
+        subprocess.run(["git", "-C", ROOT, "worktree", "add", "--detach", "--force", worktree, name], check=True)
+        try:
+            out = os.path.join(out_dir, re.sub(r"[^\w.-]", "_", name) + ".json")
+            subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "run", "--app-dir", os.path.join(worktree, "src"), "--out", out]
+                + run_arguments,
+                check=True,
+            )
+            outputs.append(out)
+        finally:
+            subprocess.run(["git", "-C", ROOT, "worktree", "remove", "--force", worktree], check=False)
+    print("results in %s" % out_dir)
+    compare(argparse.Namespace(before=outputs[0], after=outputs[1]))
+
+
+def add_run_arguments(parser):
+    parser.add_argument("--app-dir", default=os.path.join(ROOT, "src"), help="the src/ folder to benchmark")
+    parser.add_argument("--db", help="database url, its tables are DROPPED and seeded again (default: a temporary SQLite file)")
+    parser.add_argument("--mode", choices=["client", "gunicorn", "both"], default="client")
+    parser.add_argument("--people", type=int, default=1000)
+    parser.add_argument("--planets", type=int, default=1000)
+    parser.add_argument("--vehicles", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--favorites", type=int, default=20, help="favorites of each kind per user")
+    parser.add_argument("--requests", type=int, default=200, help="timed requests per route")
+    parser.add_argument("--slow-requests", type=int, default=20, help="timed requests for POST /token")
+    parser.add_argument("--warmup", type=int, default=5, help="untimed requests per route")
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn workers")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients against gunicorn")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--skip-micro", action="store_true")
+    parser.add_argument("--startup-runs", type=int, default=5, help="cold starts timed, 0 to skip")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load tests and micro-benchmarks of the API")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="seed a database, benchmark and print the results as JSON")
+    add_run_arguments(run_parser)
+    run_parser.add_argument("--out", help="write the JSON here instead of stdout")
+    compare_parser = commands.add_parser("compare", help="compare two results of `run`")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    revisions_parser = commands.add_parser(
+        "revisions", help="run the benchmarks on two git revisions and compare them, other options are passed to `run`",
+    )
+    revisions_parser.add_argument("before")
+    revisions_parser.add_argument("after")
+    revisions_parser.add_argument("--out-dir", help="keep the results here (default: a temporary folder)")
+
+    options, extra = parser.parse_known_args()
+    if options.command == "revisions":
+        revisions(options, extra)
+    elif extra:
+        parser.error("unrecognized arguments: %s" % " ".join(extra))
+    elif options.command == "run":
+        run(options)
+    else:
+        compare(options)
@@ -0,0 +1,46 @@
+"""hashed user passwords
+
+Revision ID: 07583983e64f
+Revises: 0d5e2b7a9c14
+Create Date: 2026-10-18 12:31:52.904318
+
+"""
+import os
+
+from alembic import op
+import sqlalchemy as sa
+from werkzeug.security import generate_password_hash
+
+
+# revision identifiers, used by Alembic.
+revision = '07583983e64f'
+down_revision = '0d5e2b7a9c14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # a werkzeug hash doesn't fit in 80 characters
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.alter_column(
+            'password', existing_type=sa.String(length=80), type_=sa.String(length=255), existing_nullable=False
+        )
+
+    # hash the passwords still stored in plain text
+    method = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:600000')
+    connection = op.get_bind()
+    user = sa.table('user', sa.column('id', sa.Integer), sa.column('password', sa.String))
+    for row in connection.execute(sa.select(user.c.id, user.c.password)).fetchall():
+        if row.password.startswith(('pbkdf2:', 'scrypt:')) and row.password.count('$') == 2:
+            continue
+        connection.execute(
+            user.update().where(user.c.id == row.id).values(password=generate_password_hash(row.password, method=method))
+        )
+
+
+def downgrade():
+    # the hashes can't be turned back into passwords, only the column size is restored
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.alter_column(
+            'password', existing_type=sa.String(length=255), type_=sa.String(length=80), existing_nullable=False
+        )
@@ -0,0 +1,37 @@
+"""trigram indexes on the catalog names for /search (postgres only)
+
+Revision ID: 0d5e2b7a9c14
+Revises: 632a030786ee
+Create Date: 2026-10-18 11:48:05.271655
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0d5e2b7a9c14'
+down_revision = '632a030786ee'
+branch_labels = None
+depends_on = None
+
+TABLES = ['people', 'planets', 'vehicles']
+
+
+def upgrade():
+    # the other databases use the in-memory index from src/search.py
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for table in TABLES:
+        op.create_index(
+            'ix_{}_name_trgm'.format(table), table, ['name'],
+            postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}
+        )
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    for table in TABLES:
+        op.drop_index('ix_{}_name_trgm'.format(table), table_name=table)
@@ -0,0 +1,81 @@
+"""numeric copies of the catalog stats for filtering and sorting
+
+Revision ID: 632a030786ee
+Revises: 7df943b35b92
+Create Date: 2026-10-18 11:03:27.540912
+
+"""
+import re
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '632a030786ee'
+down_revision = '7df943b35b92'
+branch_labels = None
+depends_on = None
+
+# the parsers are copied from src/models.py on purpose, a migration must keep
+# producing the same data even if the models change later
+NUMBER = re.compile(r"-?\d+(?:\.\d+)?")
+BIRTH_YEAR = re.compile(r"(\d+(?:\.\d+)?)\s*(BBY|ABY)", re.IGNORECASE)
+
+
+def parse_number(raw):
+    match = NUMBER.search((raw or "").replace(",", ""))
+    return float(match.group()) if match else None
+
+
+def parse_birth_year(raw):
+    match = BIRTH_YEAR.search(raw or "")
+    if not match:
+        return None
+    year = float(match.group(1))
+    return -year if match.group(2).upper() == "BBY" else year
+
+
+NUMERIC_COLUMNS = {
+    'planets': {'diameter': parse_number, 'population': parse_number, 'gravity': parse_number},
+    'people': {'birth': parse_birth_year},
+    'vehicles': {'speed': parse_number, 'passengers': parse_number},
+}
+
+
+def upgrade():
+    connection = op.get_bind()
+    for table_name, columns in NUMERIC_COLUMNS.items():
+        for name in columns:
+            op.add_column(table_name, sa.Column(name + '_value', sa.Float(), nullable=True))
+
+        table = sa.table(
+            table_name,
+            sa.column('id', sa.Integer),
+            *[sa.column(name, sa.String) for name in columns],
+            *[sa.column(name + '_value', sa.Float) for name in columns]
+        )
+        rows = connection.execute(sa.select(table.c.id, *[table.c[name] for name in columns])).fetchall()
+        values = [
+            dict({'row_id': row.id}, **{name + '_value': parse(row._mapping[name]) for name, parse in columns.items()})
+            for row in rows
+        ]
+        if values:
+            connection.execute(
+                table.update()
+                .where(table.c.id == sa.bindparam('row_id'))
+                .values({name + '_value': sa.bindparam(name + '_value') for name in columns}),
+                values,
+            )
+
+        for name in columns:
+            op.create_index(
+                op.f('ix_{}_{}_value'.format(table_name, name)), table_name, [name + '_value'], unique=False
+            )
+
+
+def downgrade():
+    for table_name, columns in NUMERIC_COLUMNS.items():
+        for name in columns:
+            op.drop_index(op.f('ix_{}_{}_value'.format(table_name, name)), table_name=table_name)
+            op.drop_column(table_name, name + '_value')
@@ -0,0 +1,40 @@
+"""unique (user_id, item) indexes on the favorites tables
+
+Revision ID: 7df943b35b92
+Revises: 39b9bd8dd419
+Create Date: 2026-10-18 10:12:41.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7df943b35b92'
+down_revision = '39b9bd8dd419'
+branch_labels = None
+depends_on = None
+
+FAVORITES = [
+    ('people_favorites', 'people_id'),
+    ('planet_favorites', 'planet_id'),
+    ('vehicles_favorites', 'vehicles_id'),
+]
+
+
+def upgrade():
+    for table, column in FAVORITES:
+        # keep the oldest row of every duplicated favorite, the unique index
+        # can't be created while duplicates exist. The derived table is needed
+        # by MySQL, which can't select from the table it deletes from.
+        op.execute(
+            'DELETE FROM {table} WHERE id NOT IN ('
+            'SELECT id FROM (SELECT MIN(id) AS id FROM {table} GROUP BY user_id, {column}) AS keep'
+            ')'.format(table=table, column=column)
+        )
+        op.create_index('ix_{}_user_id_{}'.format(table, column), table, ['user_id', column], unique=True)
+
+
+def downgrade():
+    for table, column in reversed(FAVORITES):
+        op.drop_index('ix_{}_user_id_{}'.format(table, column), table_name=table)
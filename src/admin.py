@@ -3,6 +3,21 @@ from flask_admin import Admin
 from models import db, User, People, Planets, Vehicles, Favorites_people, Favorites_planet, Favorites_vehicles
 from flask_admin.contrib.sqla import ModelView
 
+
+class VersionedView(ModelView):
+    # version and updated_at are stamped when the row is saved
+    def __init__(self, model, session, **kwargs):
+        self.form_excluded_columns = list(model.sync_columns) + list(getattr(self, "form_excluded_columns", None) or [])
+        super().__init__(model, session, **kwargs)
+
+
+class CatalogView(VersionedView):
+    # the numeric columns are parsed from the raw strings when the row is saved
+    def __init__(self, model, session, **kwargs):
+        self.form_excluded_columns = list(model.numeric_fields.values())
+        super().__init__(model, session, **kwargs)
+
+
 def setup_admin(app):
     app.secret_key = os.environ.get('FLASK_APP_KEY', 'sample key')
     app.config['FLASK_ADMIN_SWATCH'] = 'cerulean'
@@ -11,12 +26,12 @@ def setup_admin(app):
     
     # Add your models here, for example this is how we add a the User model to the admin
     admin.add_view(ModelView(User, db.session))
-    admin.add_view(ModelView(People, db.session))
-    admin.add_view(ModelView(Planets, db.session))
-    admin.add_view(ModelView(Vehicles, db.session))
-    admin.add_view(ModelView(Favorites_planet, db.session))
-    admin.add_view(ModelView(Favorites_people, db.session))
-    admin.add_view(ModelView(Favorites_vehicles, db.session))
+    admin.add_view(CatalogView(People, db.session))
+    admin.add_view(CatalogView(Planets, db.session))
+    admin.add_view(CatalogView(Vehicles, db.session))
+    admin.add_view(VersionedView(Favorites_planet, db.session))
+    admin.add_view(VersionedView(Favorites_people, db.session))
+    admin.add_view(VersionedView(Favorites_vehicles, db.session))
 
     # You can duplicate that line to add mew models
     # admin.add_view(ModelView(YourModelName, db.session))
\ No newline at end of file
@@ -0,0 +1,214 @@
+"""
+ASGI entry point: `uvicorn asgi:app --app-dir ./src/`
+
+The hot read endpoints (catalog details and the user favorites) are served by
+async handlers on an async SQLAlchemy engine, every other route is handed to
+the Flask app in main.py through asgiref's WSGI adapter (on a thread pool).
+"""
+import asyncio
+import os
+import re
+import time
+from asgiref.wsgi import WsgiToAsgi
+from flask_jwt_extended import decode_token
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt import PyJWTError
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header, parse_etags
+from cache import AsyncSingleFlight
+from main import (
+    app as flask_app,
+    catalog_cache,
+    catalog_columns,
+    catalog_snapshot,
+    metrics,
+    encode_cached,
+    response_encoder,
+    token_revoked,
+    user_lookup,
+)
+from models import People, Planets, Vehicles, FAVORITE_KINDS
+from serializer import dumps, row_serializer
+from utils import APIException
+
+# sync driver -> async driver, the rest of the url is kept as it is
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "mysql": "mysql+aiomysql",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def async_url(url):
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()])
+
+
+engine = create_async_engine(
+    os.environ.get("ASYNC_DB_CONNECTION_STRING") or async_url(os.environ.get("DB_CONNECTION_STRING"))
+)
+Session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+wsgi_app = WsgiToAsgi(flask_app)
+# the async twin of catalog_flights in main.py, for the misses on the event loop
+async_flights = AsyncSingleFlight()
+metrics.register_stats("catalog_async_flights", async_flights.stats)
+
+
+def authenticate(authorization, user_id=None):
+    # the same checks jwt_required() does, run on a worker thread because the
+    # revocation list and the user lookup may need the (sync) database
+    with flask_app.app_context():
+        if not authorization or not authorization.startswith("Bearer "):
+            raise APIException("Missing Authorization Header", status_code=401)
+        try:
+            token = decode_token(authorization[len("Bearer "):])
+        except (PyJWTError, JWTExtendedException) as error:
+            raise APIException(str(error), status_code=401)
+        if token_revoked(None, token):
+            raise APIException("Token has been revoked", status_code=401)
+        user = user_lookup(None, token)
+        if user is None:
+            raise APIException("User not found", status_code=401)
+        if user_id is not None and user_id != user["id"]:
+            raise APIException("You can only access your own user", status_code=403)
+        return user["id"]
+
+
+async def get_catalog_item(request, model, item_id):
+    # shares the cache (and so the ETags) with the sync handlers in main.py
+    key = (model.__tablename__, "item", item_id)
+
+    async def load():
+        generation = catalog_cache.generation(model.__tablename__)
+        serializer = row_serializer(model)
+        statement = select(*serializer.columns).where(model.id == item_id)
+        if catalog_snapshot is not None:
+            # a memory mapped local file, quicker to read in place than on a thread
+            with catalog_snapshot.connect() as connection:
+                row = connection.execute(statement).first()
+        else:
+            async with Session() as session:
+                row = (await session.execute(statement)).first()
+        if row is None:
+            raise APIException("%s %s not found" % (model.__name__, item_id), status_code=404)
+        cached = encode_cached(serializer.rows([row])[0], {})
+        catalog_cache.set(key, cached, generation)
+        return cached
+
+    if catalog_snapshot is not None:
+        catalog_snapshot.check()
+    cached = catalog_cache.get(key)
+    if cached is None:
+        cached = await async_flights.do(key, load)
+
+    body, etag, headers, variants = cached
+    body, etag, negotiated = response_encoder.cached(
+        body, etag, variants,
+        parse_accept_header(request["headers"].get("accept"), MIMEAccept),
+        parse_accept_header(request["headers"].get("accept-encoding")),
+    )
+    headers = dict(headers, ETag='"%s"' % etag, **negotiated)
+    if parse_etags(request["headers"].get("if-none-match")).contains(etag):
+        return 304, headers, b""
+    return 200, headers, body
+
+
+async def favorites_of_kind(user_id, kind):
+    favorite, foreign_key, catalog = FAVORITE_KINDS[kind]
+    columns = catalog_columns(catalog)
+    item_id = getattr(favorite, foreign_key)
+    statement = (
+        select(favorite.id, item_id, *columns)
+        .join_from(favorite, catalog, catalog.id == item_id)
+        .where(favorite.user_id == user_id)
+        .order_by(favorite.id)
+    )
+    # one session (and connection) per kind so the three queries run at the same time
+    async with Session() as session:
+        rows = (await session.execute(statement)).all()
+    result = []
+    for row in rows:
+        item = {"id": row[1]}
+        for position, column in enumerate(columns):
+            item[column.name] = row[2 + position]
+        result.append({"id": row[0], foreign_key: row[1], "item": item})
+    return result
+
+
+async def get_favorites(request, user_id=None):
+    loop = asyncio.get_running_loop()
+    user_id = await loop.run_in_executor(None, authenticate, request["headers"].get("authorization"), user_id)
+    kinds = list(FAVORITE_KINDS)
+    results = await asyncio.gather(*[favorites_of_kind(user_id, kind) for kind in kinds])
+    return 200, {}, dumps(dict(zip(kinds, results)))
+
+
+# (path, handler, its arguments, the Flask rule it stands for in /metrics)
+ROUTES = [
+    (re.compile(r"^/user/favorites/?$"), get_favorites, {}, "/user/favorites"),
+    (re.compile(r"^/user/(?P<user_id>\d+)/favorites/?$"), get_favorites, {}, "/user/<int:user_id>/favorites"),
+    (re.compile(r"^/people/(?P<item_id>\d+)/?$"), get_catalog_item, {"model": People}, "/people/<int:people_id>"),
+    (re.compile(r"^/planets/(?P<item_id>\d+)/?$"), get_catalog_item, {"model": Planets}, "/planets/<int:planet_id>"),
+    (re.compile(r"^/vehicles/(?P<item_id>\d+)/?$"), get_catalog_item, {"model": Vehicles}, "/vehicles/<int:vehicle_id>"),
+]
+
+
+async def send_response(send, status, headers, body):
+    headers = dict(headers)
+    headers.setdefault("Content-Type", "application/json")
+    headers["Content-Length"] = str(len(body))
+    headers["Access-Control-Allow-Origin"] = "*"
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers.items()],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await engine.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    if scope["type"] == "http" and scope["method"] == "GET":
+        for pattern, handler, kwargs, endpoint in ROUTES:
+            match = pattern.match(scope["path"])
+            if match is None:
+                continue
+            started_at = time.perf_counter()
+            request = {
+                "headers": {name.decode("latin-1"): value.decode("latin-1") for name, value in scope["headers"]},
+            }
+            kwargs = dict(kwargs, **{name: int(value) for name, value in match.groupdict().items()})
+            try:
+                status, headers, body = await handler(request, **kwargs)
+            except APIException as error:
+                status, headers, body = error.status_code, {}, dumps(error.to_dict())
+            except Exception:
+                metrics.observe(endpoint, "GET", 500, time.perf_counter() - started_at)
+                raise
+            if "Content-Type" not in headers:
+                # not a cached response (those are negotiated already): JSON to
+                # convert and compress like the Flask responses
+                body, encoded = response_encoder.encode(
+                    body,
+                    parse_accept_header(request["headers"].get("accept"), MIMEAccept),
+                    parse_accept_header(request["headers"].get("accept-encoding")),
+                )
+                headers = dict(headers, **encoded)
+            await send_response(send, status, headers, body)
+            metrics.observe(endpoint, "GET", status, time.perf_counter() - started_at, len(body))
+            return
+
+    await wsgi_app(scope, receive, send)
@@ -0,0 +1,208 @@
+"""
+In-process LRU/TTL cache for the catalog (People, Planets, Vehicles) responses
+"""
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+
+class SingleFlight:
+    # Concurrent calls of do() with the same key run fn() once: the first caller
+    # runs it, the others wait and get its result (or its exception).
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = {"done": threading.Event()}
+                self.calls += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        if not leader:
+            flight["done"].wait()
+            if "error" in flight:
+                raise flight["error"]
+            return flight["value"]
+        try:
+            flight["value"] = fn()
+            return flight["value"]
+        except Exception as error:
+            flight["error"] = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight["done"].set()
+
+    def stats(self):
+        with self._lock:
+            return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self._flights)}
+
+
+class AsyncSingleFlight:
+    # SingleFlight for coroutines, on one event loop
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._flights = {}
+
+    async def do(self, key, fn):
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.coalesced += 1
+            return await asyncio.shield(flight)
+        flight = self._flights[key] = asyncio.get_running_loop().create_future()
+        self.calls += 1
+        try:
+            value = await fn()
+        except asyncio.CancelledError:
+            flight.cancel()
+            raise
+        except Exception as error:
+            flight.set_exception(error)
+            flight.exception()  # retrieved, even if nobody was waiting
+            raise
+        else:
+            flight.set_result(value)
+            return value
+        finally:
+            del self._flights[key]
+
+    def stats(self):
+        return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self._flights)}
+
+
+class LRUCache:
+    # Keys are tuples whose first item is the table name, that is what
+    # invalidate() uses to drop every entry built from a table. With a
+    # SingleFlight the concurrent misses of a key share one build.
+
+    def __init__(self, maxsize=1024, ttl=300, flights=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.flights = flights
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._generations = {}
+        # bumped by clear(), it covers the tables never invalidated too
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, generation=None):
+        with self._lock:
+            # a write to the table happened while the value was being built,
+            # storing it now would bring back what invalidate() just dropped
+            if generation is not None and generation != (self._epoch, self._generations.get(key[0], 0)):
+                return
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def generation(self, table):
+        # pass it to set() to drop a value built while the table was written
+        # (or while the whole cache was cleared)
+        with self._lock:
+            return self._epoch, self._generations.get(table, 0)
+
+    def get_or_set(self, key, builder):
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            if self.flights is not None:
+                return self.flights.do(key, lambda: self._build(key, builder))
+            value = self._build(key, builder)
+        return value
+
+    def _build(self, key, builder):
+        generation = self.generation(key[0])
+        value = builder()
+        self.set(key, value, generation)
+        return value
+
+    def invalidate(self, table):
+        with self._lock:
+            self._generations[table] = self._generations.get(table, 0) + 1
+            for key in [key for key in self._entries if key[0] == table]:
+                del self._entries[key]
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+
+def invalidate_on_change(cache, models):
+    # Mapper events fire for every ORM flush, that includes the flask-admin
+    # ModelViews because they write through the same db.session. The table is
+    # dropped at flush time and once more after the commit, so a read that
+    # raced with the transaction can't leave the old rows cached.
+    # Other gunicorn workers only see the change once their entries expire (ttl).
+    changed_tables = ("cache_changed_tables", id(cache))
+
+    def on_change(mapper, connection, target):
+        table = mapper.local_table.name
+        cache.invalidate(table)
+        session = object_session(target)
+        if session is not None:
+            session.info.setdefault(changed_tables, set()).add(table)
+
+    for model in models:
+        for name in ("after_insert", "after_update", "after_delete"):
+            event.listen(model, name, on_change)
+
+    @event.listens_for(Session, "after_commit")
+    def on_commit(session):
+        for table in session.info.pop(changed_tables, ()):
+            cache.invalidate(table)
+
+    @event.listens_for(Session, "after_rollback")
+    def on_rollback(session):
+        session.info.pop(changed_tables, None)
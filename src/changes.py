@@ -0,0 +1,74 @@
+"""
+Change feed of the catalog and the favorites: what changed since a client's last sync
+"""
+from sqlalchemy import or_, select
+from models import ChangeCounter, Tombstone, CATALOG_MODELS, FAVORITE_KINDS
+from serializer import row_serializer
+
+DEFAULT_CHANGES_LIMIT = 1000
+MAX_CHANGES_LIMIT = 5000
+
+
+def current_version(session):
+    return session.execute(select(ChangeCounter.version).where(ChangeCounter.id == 1)).scalar() or 0
+
+
+def changes_since(session, since, user_id=None, limit=DEFAULT_CHANGES_LIMIT):
+    # The catalog rows (and the favorites of `user_id`) written after version
+    # `since`, plus the ids deleted since then, read through the version indexes.
+    #
+    # Around `limit` rows per table are returned: the page stops before the first
+    # version that didn't fit, so a version is never split across two pages (a
+    # single version bigger than the limit, like an import batch, comes whole).
+    # The client applies "deleted" then "changed" and asks again with
+    # ?since=<version> while "more" is true.
+    sources = [("catalog", kind, model, []) for kind, model in CATALOG_MODELS.items()]
+    if user_id is not None:
+        sources += [
+            ("favorites", kind, favorite, [favorite.user_id == user_id])
+            for kind, (favorite, _, _) in FAVORITE_KINDS.items()
+        ]
+    tombstone_filters = [Tombstone.user_id.is_(None)]
+    if user_id is not None:
+        tombstone_filters.append(Tombstone.user_id == user_id)
+    tombstone_filter = or_(*tombstone_filters)
+
+    latest = current_version(session)
+    upto = latest
+    for version, filters in [(model.version, filters) for _, _, model, filters in sources] + [
+        (Tombstone.version, [tombstone_filter])
+    ]:
+        cut = session.execute(
+            select(version).where(version > since, *filters).order_by(version).offset(limit).limit(1)
+        ).scalar()
+        if cut is None:
+            continue
+        # the page ends on the last version before the cut that has rows, or on
+        # the cut itself when it is the first version of the table after `since`
+        last = session.execute(
+            select(version).where(version > since, version < cut, *filters).order_by(version.desc()).limit(1)
+        ).scalar()
+        upto = min(upto, last if last is not None else cut)
+
+    result = {"catalog": {}}
+    if user_id is not None:
+        result["favorites"] = {}
+    sections = {}
+    for section, kind, model, filters in sources:
+        serializer = row_serializer(model)
+        rows = session.execute(
+            select(*serializer.columns)
+            .where(model.version > since, model.version <= upto, *filters)
+            .order_by(model.id)
+        )
+        result[section][kind] = {"changed": serializer.rows(rows), "deleted": []}
+        sections[model.__tablename__] = result[section][kind]["deleted"]
+    for table_name, row_id in session.execute(
+        select(Tombstone.table_name, Tombstone.row_id)
+        .where(Tombstone.version > since, Tombstone.version <= upto, tombstone_filter)
+        .order_by(Tombstone.version, Tombstone.id)
+    ):
+        if table_name in sections:
+            sections[table_name].append(row_id)
+
+    return {"since": since, "version": upto, "more": upto < latest, "changes": result}
@@ -0,0 +1,125 @@
+"""
+Response compression (gzip, brotli) and MessagePack responses, negotiated per request
+"""
+import gzip
+import json
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+MSGPACK_TYPES = (MSGPACK, "application/x-msgpack")
+COMPRESSIBLE = (JSON, MSGPACK, "application/x-ndjson", "text/html", "text/plain")
+# appended to the ETag of every variant, so a cached 304 matches the bytes the client has
+TAG_SUFFIXES = {MSGPACK: "-mp", "gzip": "-gz", "br": "-br"}
+
+
+def compress(data, encoding, level):
+    if encoding == "br":
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def to_msgpack(json_body):
+    return msgpack.packb(json.loads(json_body), use_bin_type=True)
+
+
+class ResponseEncoder:
+    # Responses of `min_size` bytes or more are sent gzip or brotli compressed
+    # (brotli when the client takes it and the package is installed), `level` is
+    # the gzip level or the brotli quality, both go from 1 to 9. With
+    # `Accept: application/msgpack` (and msgpack installed) JSON responses are
+    # sent as MessagePack instead.
+    #
+    # The cached catalog responses keep every variant a client asked for next to
+    # the cached JSON, compressed once at a higher level, instead of compressing
+    # the same bytes on every hit.
+
+    def __init__(self, min_size=1024, level=6, cached_level=9):
+        self.min_size = min_size
+        self.level = level
+        self.cached_level = cached_level
+
+    def media_type(self, accept_mimetypes):
+        if msgpack is None:
+            return JSON
+        best = accept_mimetypes.best_match((JSON,) + MSGPACK_TYPES, default=JSON)
+        return MSGPACK if best in MSGPACK_TYPES else JSON
+
+    def content_encoding(self, accept_encodings, size):
+        if size < self.min_size:
+            return None
+        if brotli is not None and accept_encodings["br"]:
+            return "br"
+        if accept_encodings["gzip"]:
+            return "gzip"
+        return None
+
+    def cached(self, body, etag, variants, accept_mimetypes, accept_encodings):
+        # -> (body, etag, headers) of a cached JSON body in the negotiated form.
+        # `variants` is the dict kept with the cache entry, filled as needed.
+        media_type = self.media_type(accept_mimetypes)
+        if media_type != JSON and (media_type, None) not in variants:
+            variants[(media_type, None)] = to_msgpack(body)
+        data = variants[(media_type, None)] if media_type != JSON else body
+        encoding = self.content_encoding(accept_encodings, len(data))
+        if encoding is not None and (media_type, encoding) not in variants:
+            variants[(media_type, encoding)] = compress(data, encoding, self.cached_level)
+        headers = {"Content-Type": media_type, "Vary": "Accept, Accept-Encoding"}
+        if media_type != JSON:
+            etag += TAG_SUFFIXES[media_type]
+        if encoding is not None:
+            data = variants[(media_type, encoding)]
+            etag += TAG_SUFFIXES[encoding]
+            headers["Content-Encoding"] = encoding
+        return data, etag, headers
+
+    def encode(self, body, accept_mimetypes, accept_encodings):
+        # -> (body, headers) of a JSON body that isn't cached, what after_request
+        # does to a Flask response, for the async handlers of asgi.py
+        headers = {"Content-Type": JSON}
+        vary = ["Accept-Encoding"]
+        if msgpack is not None:
+            vary.insert(0, "Accept")
+            if self.media_type(accept_mimetypes) == MSGPACK:
+                body = to_msgpack(body)
+                headers["Content-Type"] = MSGPACK
+        headers["Vary"] = ", ".join(vary)
+        encoding = self.content_encoding(accept_encodings, len(body))
+        if encoding is not None:
+            body = compress(body, encoding, self.level)
+            headers["Content-Encoding"] = encoding
+        return body, headers
+
+    def after_request(self, response):
+        # every other response: converted and compressed on the way out. The
+        # streamed ones (the exports compress themselves) and the cached ones
+        # (they have an ETag) are left alone.
+        if response.is_streamed or response.direct_passthrough or "ETag" in response.headers \
+                or "Content-Encoding" in response.headers or response.status_code in (204, 304):
+            return response
+        if response.mimetype == JSON and msgpack is not None:
+            response.vary.add("Accept")
+            if self.media_type(request.accept_mimetypes) == MSGPACK:
+                response.set_data(to_msgpack(response.get_data()))
+                response.mimetype = MSGPACK
+        if response.mimetype not in COMPRESSIBLE:
+            return response
+        response.vary.add("Accept-Encoding")
+        encoding = self.content_encoding(request.accept_encodings, response.content_length or 0)
+        if encoding is not None:
+            response.set_data(compress(response.get_data(), encoding, self.level))
+            response.headers["Content-Encoding"] = encoding
+        return response
+
+    def init_app(self, app):
+        app.after_request(self.after_request)
@@ -0,0 +1,212 @@
+"""
+Bulk import of People, Planets and Vehicles: `flask import-catalog people people.csv`
+"""
+import csv
+import io
+import json
+import os
+import re
+import time
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import bindparam, insert, select, update
+from models import db, numeric_values, sync_stamp, CATALOG_MODELS
+from serializer import exposed_columns
+
+# names used by SWAPI (and its dumps) -> our column names
+ALIASES = {
+    "people": {"birth_year": "birth", "eye_color": "eyes_color"},
+    "planets": {},
+    "vehicles": {"manufacturer": "crafter", "crew": "tripulation", "max_atmosphering_speed": "speed"},
+}
+FORMATS = {".csv": "csv", ".json": "json", ".ndjson": "ndjson", ".jsonl": "ndjson"}
+SEPARATORS = re.compile(r"[\s,]*")
+CHUNK_SIZE = 1 << 16
+
+
+def iter_json(file):
+    # The items of a JSON array, read one at a time so a huge file is never fully
+    # in memory. A single object (a SWAPI page) is read whole, its "results" used.
+    decoder = json.JSONDecoder()
+    buffer = file.read(CHUNK_SIZE)
+    position = SEPARATORS.match(buffer).end()
+    if buffer[position:position + 1] == "{":
+        yield from json.loads(buffer + file.read()).get("results", [])
+        return
+    if buffer[position:position + 1] != "[":
+        raise click.ClickException("a JSON file must contain an array or an object")
+    position += 1
+    while True:
+        position = SEPARATORS.match(buffer, position).end()
+        if buffer[position:position + 1] == "]":
+            return
+        try:
+            item, position = decoder.raw_decode(buffer, position)
+        except ValueError:
+            more = file.read(CHUNK_SIZE)
+            if not more:
+                raise click.ClickException("the JSON array is invalid or incomplete")
+            buffer, position = buffer[position:] + more, 0
+            continue
+        yield item
+
+
+def read_items(file, file_format):
+    if file_format == "csv":
+        yield from csv.DictReader(file)
+    elif file_format == "ndjson":
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        # items, SWAPI pages ({"results": [...]}) or SWAPI fixtures ({"fields": {...}})
+        for item in iter_json(file):
+            if isinstance(item, dict) and isinstance(item.get("results"), list):
+                yield from item["results"]
+            elif isinstance(item, dict) and isinstance(item.get("fields"), dict):
+                yield item["fields"]
+            else:
+                yield item
+
+
+def clean_rows(kind, items):
+    # -> (row, None) for a valid item or (None, error). A row has every column
+    # serialize() exposes (a non empty string that fits) and its numeric copies.
+    model = CATALOG_MODELS[kind]
+    columns = []
+    for column in exposed_columns(model):
+        if column.name != "id":
+            # the keys the value may come in, ours first
+            keys = [column.name] + [alias for alias, name in ALIASES[kind].items() if name == column.name]
+            columns.append((column.name, keys, column.type.length))
+    for item in items:
+        if not isinstance(item, dict):
+            yield None, "not an object"
+            continue
+        row, error = {}, None
+        for name, keys, length in columns:
+            for key in keys:
+                value = item.get(key)
+                if value is not None:
+                    break
+            value = (value if type(value) is str else "" if value is None else str(value)).strip()
+            if not value:
+                error = "%s is missing" % name
+                break
+            if length and len(value) > length:
+                error = "%s is longer than %d characters" % (name, length)
+                break
+            row[name] = value
+        if error:
+            yield None, error
+            continue
+        row.update(numeric_values(model, row))
+        yield row, None
+
+
+def copy_rows(table, rows):
+    # Postgres COPY, the fastest way in. Required values are never empty strings,
+    # so an empty unquoted CSV field can only be a NULL numeric value.
+    names = list(rows[0])
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row[name] for name in names])
+    buffer.seek(0)
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            "COPY %s (%s) FROM STDIN WITH (FORMAT csv)" % (table.name, ", ".join(names)), buffer,
+        )
+    finally:
+        cursor.close()
+
+
+def load_batch(table, rows, upsert, use_copy):
+    # -> (inserted, updated). With upsert the rows whose name already exists are
+    # updated (every row with that name, by id), the rest is inserted. Each batch
+    # is one version of the /changes feed.
+    stamp = sync_stamp()
+    for row in rows:
+        row.update(stamp)
+    updates = []
+    if upsert:
+        # the last row wins when a name is repeated in the batch
+        rows = list({row["name"]: row for row in rows}.values())
+        existing = {}
+        for name, row_id in db.session.execute(
+            select(table.c.name, table.c.id).where(table.c.name.in_([row["name"] for row in rows]))
+        ):
+            existing.setdefault(name, []).append(row_id)
+        updates = [dict(row, match_id=row_id) for row in rows for row_id in existing.get(row["name"], ())]
+        rows = [row for row in rows if row["name"] not in existing]
+    if updates:
+        names = [name for name in updates[0] if name not in ("name", "match_id")]
+        db.session.execute(
+            update(table).where(table.c.id == bindparam("match_id"))
+            .values({name: bindparam(name) for name in names}),
+            updates,
+        )
+    if rows:
+        if use_copy:
+            copy_rows(table, rows)
+        else:
+            db.session.execute(insert(table), rows)
+    db.session.commit()
+    return len(rows), len(updates)
+
+
+@click.command("import-catalog")
+@click.argument("kind", type=click.Choice(list(CATALOG_MODELS)))
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "file_format", type=click.Choice(["csv", "json", "ndjson"]),
+              help="Format of the file, by default taken from its extension.")
+@click.option("--upsert", is_flag=True, help="Update the rows with the same name instead of adding them again.")
+@click.option("--batch-size", default=5000, show_default=True, help="Rows written per statement and commit.")
+@click.option("--copy/--no-copy", "use_copy", default=True, show_default=True,
+              help="Insert with COPY on Postgres (psycopg2).")
+@click.option("--max-errors", default=20, show_default=True, help="Invalid rows reported in detail.")
+@with_appcontext
+def import_catalog(kind, path, file_format, upsert, batch_size, use_copy, max_errors):
+    """Import People, Planets or Vehicles from a CSV, JSON, NDJSON or SWAPI dump file.
+
+    Rows are validated while the file is read and written in batches, each batch
+    in its own transaction. The API caches expire after their TTL.
+    """
+    file_format = file_format or FORMATS.get(os.path.splitext(path)[1].lower())
+    if file_format is None:
+        raise click.UsageError("Can't tell the format from the file extension, use --format")
+    table = CATALOG_MODELS[kind].__table__
+    bind = db.session.get_bind()
+    use_copy = use_copy and bind.dialect.name == "postgresql" and bind.dialect.driver == "psycopg2"
+
+    started_at = reported_at = time.perf_counter()
+    read = inserted = updated = invalid = 0
+    batch = []
+
+    def report(final=False):
+        elapsed = time.perf_counter() - started_at
+        click.echo("\r%s: %d rows read, %d inserted, %d updated, %d invalid, %.0f rows/s" % (
+            kind, read, inserted, updated, invalid, read / elapsed if elapsed else 0,
+        ), err=True, nl=final)
+
+    with open(path, newline="" if file_format == "csv" else None, encoding="utf-8") as file:
+        for row, error in clean_rows(kind, read_items(file, file_format)):
+            read += 1
+            if error:
+                invalid += 1
+                if invalid <= max_errors:
+                    click.echo("\rrow %d: %s" % (read, error), err=True)
+                continue
+            batch.append(row)
+            if len(batch) >= batch_size:
+                counts = load_batch(table, batch, upsert, use_copy)
+                inserted, updated = inserted + counts[0], updated + counts[1]
+                batch = []
+                if time.perf_counter() - reported_at >= 1:
+                    reported_at = time.perf_counter()
+                    report()
+        if batch:
+            counts = load_batch(table, batch, upsert, use_copy)
+            inserted, updated = inserted + counts[0], updated + counts[1]
+    report(final=True)
@@ -0,0 +1,38 @@
+"""
+Serves /admin from an app built on its first request, so workers don't import flask-admin on boot
+"""
+import threading
+from flask import Flask
+
+
+class LazyAdmin:
+    # WSGI middleware in front of the API app. Requests to /admin go to a small
+    # Flask app holding only flask-admin, with the same config and database,
+    # built the first time it is needed. Workers that never get an /admin
+    # request never import flask-admin or build its seven ModelViews.
+
+    def __init__(self, app, wsgi_app):
+        self.app = app
+        self.wsgi_app = wsgi_app
+        self.admin_app = None
+        self._lock = threading.Lock()
+
+    def build(self):
+        from admin import setup_admin
+        from models import db
+
+        admin_app = Flask(__name__)
+        admin_app.config.update(self.app.config)
+        db.init_app(admin_app)
+        setup_admin(admin_app)
+        return admin_app
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        if path != "/admin" and not path.startswith("/admin/"):
+            return self.wsgi_app(environ, start_response)
+        if self.admin_app is None:
+            with self._lock:
+                if self.admin_app is None:
+                    self.admin_app = self.build()
+        return self.admin_app(environ, start_response)
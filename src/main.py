@@ -1,14 +1,42 @@
 """
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
 """
+import time
+
+# the worker cold start is measured from here, before the (slow) imports
+STARTED_AT = time.perf_counter()
+
+import functools
+import hashlib
+import hmac
 import os
-from flask_jwt_extended import JWTManager, create_access_token, get_jwt_identity, jwt_required
-from flask import Flask, request, jsonify, url_for
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+from flask_jwt_extended import JWTManager, create_access_token, get_current_user, get_jwt, get_jwt_identity, jwt_required
+from flask import Flask, request, jsonify, stream_with_context, url_for
 from flask_migrate import Migrate
 from flask_swagger import swagger
 from flask_cors import CORS
-from utils import APIException, generate_sitemap
-from admin import setup_admin
+from werkzeug.middleware.proxy_fix import ProxyFix
+from sqlalchemy import String, cast, delete, literal, null, select, text, union_all
+from cache import LRUCache, SingleFlight, invalidate_on_change
+from changes import DEFAULT_CHANGES_LIMIT, MAX_CHANGES_LIMIT, changes_since
+from compression import ResponseEncoder
+from search import NameIndex, postgres_search
+from serializer import dumps, exposed_columns, row_serializer
+from snapshot import CatalogSnapshot, export_snapshot
+from revocation import RevocationList
+from pool_metrics import PoolMetrics, engine_options
+from metrics import Metrics
+from profiling import SQLProfiler
+from ratelimit import RateLimiter, rate_limit_backend
+from replicas import ReplicaRouter
+from passwords import LoginThrottle, hash_password_capped, needs_rehash, verify_password_capped
+from utils import APIException, generate_sitemap, paginate
+from lazy_admin import LazyAdmin
+from importer import import_catalog
+from leaderboard import Leaderboard, recount_favorites
 from models import (
     db,
     User,
@@ -18,20 +46,191 @@ from models import (
     Favorites_people,
     Favorites_planet,
     Favorites_vehicles,
+    RevokedToken,
+    CATALOG_MODELS,
+    FAVORITE_KINDS,
+    count_favorites,
+    insert_ignore,
+    record_deletes,
+    sync_stamp,
 )
 
 # from models import Person
 
+IMPORTED_AT = time.perf_counter()
 app = Flask(__name__)
-app.config["JWT_SECRET_KEY"] = "super-secret"
+app.config["JWT_SECRET_KEY"] = os.environ.get("JWT_SECRET_KEY", "super-secret")
 jwt = JWTManager(app)
 app.url_map.strict_slashes = False
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DB_CONNECTION_STRING")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(os.environ, app.config["SQLALCHEMY_DATABASE_URI"])
 MIGRATE = Migrate(app, db)
 db.init_app(app)
+pool_metrics = PoolMetrics()
+with app.app_context():
+    pool_metrics.attach(db.engine)
+
+# DB_REPLICA_URLS: comma separated read replica urls, the GET requests read from them
+replica_router = None
+if os.environ.get("DB_REPLICA_URLS"):
+    replica_router = ReplicaRouter(
+        [url.strip() for url in os.environ["DB_REPLICA_URLS"].split(",") if url.strip()],
+        engine_options=lambda url: engine_options(os.environ, url),
+        retry_after=float(os.environ.get("DB_REPLICA_RETRY_SECONDS", 30)),
+        pin_seconds=float(os.environ.get("DB_REPLICA_PIN_SECONDS", 5)),
+        check_interval=float(os.environ.get("DB_REPLICA_CHECK_SECONDS", 5)),
+    )
+    replica_router.init_app(app)
 CORS(app)
-setup_admin(app)
+
+# ADMIN_MODE: "lazy" (default) builds flask-admin on the first /admin request,
+# "eager" on boot like before and "off" leaves it out (API only workers)
+ADMIN_MODE = os.environ.get("ADMIN_MODE", "lazy")
+if ADMIN_MODE == "eager":
+    from admin import setup_admin
+    setup_admin(app)
+elif ADMIN_MODE == "lazy":
+    app.wsgi_app = LazyAdmin(app, app.wsgi_app)
+
+# PROXY_FIX_HOPS: proxies in front of the app whose X-Forwarded-For/-Proto are
+# trusted. 0 (reached directly: flask run, a bare gunicorn) unless a proxy
+# really is there, the Procfile sets 1 for the Heroku router.
+PROXY_FIX_HOPS = int(os.environ.get("PROXY_FIX_HOPS", 0))
+if PROXY_FIX_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_FIX_HOPS, x_proto=PROXY_FIX_HOPS)
+app.cli.add_command(import_catalog)
+app.cli.add_command(recount_favorites)
+app.cli.add_command(export_snapshot)
+
+# a burst of requests for an item that isn't cached makes one query, not one each
+catalog_flights = SingleFlight()
+catalog_cache = LRUCache(
+    maxsize=int(os.environ.get("CATALOG_CACHE_SIZE", 1024)),
+    ttl=float(os.environ.get("CATALOG_CACHE_TTL", 300)),
+    flights=catalog_flights,
+)
+invalidate_on_change(catalog_cache, [People, Planets, Vehicles])
+
+# CATALOG_SNAPSHOT: a file written by `flask export-snapshot`, the catalog routes
+# then read it instead of the database (the favorites, users and tokens don't)
+catalog_snapshot = None
+if os.environ.get("CATALOG_SNAPSHOT"):
+    catalog_snapshot = CatalogSnapshot(
+        os.environ["CATALOG_SNAPSHOT"],
+        check_interval=float(os.environ.get("SNAPSHOT_CHECK_SECONDS", 1)),
+        on_reload=[catalog_cache.clear],
+    )
+
+SEARCH_BACKEND = os.environ.get("SEARCH_BACKEND", "memory")
+search_index = NameIndex(CATALOG_MODELS, ttl=float(os.environ.get("SEARCH_INDEX_TTL", 300)))
+search_index.listen()
+
+leaderboard = Leaderboard(
+    CATALOG_MODELS,
+    size=int(os.environ.get("LEADERBOARD_SIZE", 100)),
+    ttl=float(os.environ.get("LEADERBOARD_TTL", 5)),
+)
+
+# RATE_LIMIT_BACKEND: "memory" (per worker) or a redis:// url shared by every worker,
+# the limits are requests per second and burst size per client, a rate of 0 turns them off.
+# Anonymous clients are told apart by their address: behind a proxy set PROXY_FIX_HOPS
+# or they all share the proxy's bucket, without one leave it at 0 or a client sending
+# its own X-Forwarded-For gets a new bucket with every request.
+limiter = RateLimiter(
+    rate_limit_backend(os.environ.get("RATE_LIMIT_BACKEND", "memory")),
+    {
+        "token": (
+            float(os.environ.get("RATE_LIMIT_TOKEN_RATE", 1)),
+            int(os.environ.get("RATE_LIMIT_TOKEN_BURST", 10)),
+        ),
+        "list": (
+            float(os.environ.get("RATE_LIMIT_LIST_RATE", 20)),
+            int(os.environ.get("RATE_LIMIT_LIST_BURST", 100)),
+        ),
+    },
+)
+
+# the failures are counted per email and client address, a stranger guessing
+# can't lock the owner of the email out
+login_throttle = LoginThrottle(
+    max_attempts=int(os.environ.get("LOGIN_MAX_ATTEMPTS", 5)),
+    window=float(os.environ.get("LOGIN_LOCKOUT_SECONDS", 300)),
+)
+
+# the user behind a token (its identity is the email) is resolved once and kept
+# in a small cache, so authenticated requests don't pay an extra User query
+user_cache = LRUCache(
+    maxsize=int(os.environ.get("USER_CACHE_SIZE", 1024)),
+    ttl=float(os.environ.get("USER_CACHE_TTL", 60)),
+)
+invalidate_on_change(user_cache, [User])
+# REVOCATION_REFRESH_SECONDS: how long a logged out token can still be used on
+# the other workers, 0 to check for new revocations on every request
+revocation_list = RevocationList(
+    RevokedToken,
+    refresh=float(os.environ.get("REVOCATION_REFRESH_SECONDS", 5)),
+    capacity=int(os.environ.get("REVOCATION_FILTER_CAPACITY", 100000)),
+)
+
+
+@jwt.user_lookup_loader
+def user_lookup(jwt_header, jwt_data):
+    email = jwt_data["sub"]
+
+    def load():
+        user = User.query.filter_by(email=email).first()
+        if user is None or not user.is_active:
+            return None
+        return user.serialize()
+
+    return user_cache.get_or_set((User.__tablename__, email), load)
+
+
+@jwt.token_in_blocklist_loader
+def token_revoked(jwt_header, jwt_data):
+    return revocation_list.is_revoked(jwt_data["jti"])
+
+
+def token_user_id(user_id=None):
+    # the user always comes from the token, an id in the url must be the same one
+    user = get_current_user()
+    if user_id is not None and user_id != user["id"]:
+        raise APIException("You can only access your own user", status_code=403)
+    return user["id"]
+
+
+metrics = Metrics()
+metrics.init_app(app)
+metrics.register_stats("catalog_cache", catalog_cache.stats)
+metrics.register_stats("catalog_flights", catalog_flights.stats)
+metrics.register_stats("rate_limit", limiter.stats)
+metrics.register_stats("login_throttle", login_throttle.stats)
+metrics.register_stats("user_cache", user_cache.stats)
+metrics.register_stats("token_revocations", revocation_list.stats)
+metrics.register_stats("db_pool", pool_metrics.stats)
+metrics.register_stats("leaderboard", leaderboard.stats)
+if replica_router is not None:
+    metrics.register_stats("db_replicas", replica_router.stats)
+if catalog_snapshot is not None:
+    metrics.register_stats("catalog_snapshot", catalog_snapshot.stats)
+
+# after the metrics hooks, so they see the size of the compressed responses
+response_encoder = ResponseEncoder(
+    min_size=int(os.environ.get("COMPRESS_MIN_SIZE", 1024)),
+    level=int(os.environ.get("COMPRESS_LEVEL", 6)),
+)
+response_encoder.init_app(app)
+
+sql_profiler = SQLProfiler(
+    always=os.environ.get("SQL_PROFILE") == "1",
+    allow_header=os.environ.get("SQL_PROFILE_ALLOW_HEADER") == "1",
+    repeat_threshold=int(os.environ.get("SQL_PROFILE_REPEAT_THRESHOLD", 3)),
+)
+sql_profiler.init_app(app, [
+    User, People, Planets, Vehicles, Favorites_people, Favorites_planet, Favorites_vehicles, RevokedToken,
+])
+
 
 # Handle/serialize errors like a JSON object
 @app.errorhandler(APIException)
@@ -39,27 +238,211 @@ def handle_invalid_usage(error):
     return jsonify(error.to_dict()), error.status_code
 
 
-# generate sitemap with all your endpoints
+def json_response(result, status=200):
+    # for results built by the row serializers (orjson when installed)
+    return app.response_class(dumps(result), status=status, mimetype="application/json")
+
+
+def encode_cached(result, headers):
+    # the last item holds the compressed / MessagePack variants, see ResponseEncoder
+    body = dumps(result)
+    return body, hashlib.sha1(body).hexdigest(), headers, {}
+
+
+def cached_response(key, build):
+    # build() returns (result, headers). The cache keeps the encoded body and its
+    # hash, so a hit skips serialize() and the json encoder and a matching
+    # If-None-Match is answered with a 304 without touching the database.
+    if catalog_snapshot is not None:
+        catalog_snapshot.check()
+    body, etag, headers, variants = catalog_cache.get_or_set(key, lambda: encode_cached(*build()))
+    body, etag, negotiated = response_encoder.cached(
+        body, etag, variants, request.accept_mimetypes, request.accept_encodings,
+    )
+    response = app.response_class(body, headers=dict(headers, **negotiated))
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+
+@contextmanager
+def catalog_reader():
+    # where the catalog is read from: the snapshot in snapshot mode, else the database
+    if catalog_snapshot is None:
+        yield db.session
+    else:
+        with catalog_snapshot.connect() as connection:
+            yield connection
+
+
+def catalog_item(model, item_id):
+    def load():
+        serializer = row_serializer(model)
+        with catalog_reader() as reader:
+            row = reader.execute(select(*serializer.columns).where(model.id == item_id)).first()
+        if row is None:
+            raise APIException("%s %s not found" % (model.__name__, item_id), status_code=404)
+        return serializer.rows([row])[0], {}
+
+    return cached_response((model.__tablename__, "item", item_id), load)
+
+
+def catalog_list(model):
+    def load():
+        with catalog_reader() as reader:
+            result, next_after = paginate(model, request.args, reader)
+        headers = {}
+        if next_after is not None:
+            args = request.args.to_dict()
+            args["after"] = next_after
+            headers["Link"] = '<%s>; rel="next"' % url_for(request.endpoint, **args)
+        return result, headers
+
+    key = (model.__tablename__, "list", tuple(sorted(request.args.items(multi=True))))
+    return cached_response(key, load)
+
+
+# generate sitemap with all your endpoints, once: see the end of this file
 @app.route("/")
 def sitemap():
-    return generate_sitemap(app)
+    response = app.response_class(SITEMAP_HTML, mimetype="text/html")
+    response.set_etag(SITEMAP_ETAG)
+    return response.make_conditional(request)
+
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    # for the load balancer, no database work unless asked with ?db=1
+    response_body = {
+        "status": "ok",
+        "uptime_seconds": round(time.perf_counter() - STARTED_AT, 3),
+        "startup": STARTUP,
+    }
+    if request.args.get("db") == "1" or HEALTHZ_DB_PING:
+        try:
+            # the primary, a GET would otherwise be routed to a replica
+            with db.engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+            response_body["database"] = "ok"
+        except Exception as error:
+            response_body.update(status="unavailable", database=error.__class__.__name__)
+            return jsonify(response_body), 503
+    return jsonify(response_body), 200
+
+
+# STATS_ALLOW_IPS, STATS_TOKEN: /cache/stats, /metrics and /pool/stats show
+# the internals of the workers, they answer the peers of the list (localhost
+# by default) and the requests with Authorization: Bearer <STATS_TOKEN> (off
+# when empty). The peer is the socket's address, not the X-Forwarded-For one:
+# behind a proxy it is the proxy's, so there the token is the way in.
+STATS_ALLOW_IPS = {ip.strip() for ip in os.environ.get("STATS_ALLOW_IPS", "127.0.0.1,::1").split(",") if ip.strip()}
+STATS_TOKEN = os.environ.get("STATS_TOKEN", "")
+
+
+def internal_only(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        authorization = request.headers.get("Authorization", "").encode("utf-8")
+        peer = request.environ.get("werkzeug.proxy_fix.orig", request.environ).get("REMOTE_ADDR")
+        if peer not in STATS_ALLOW_IPS and not (
+            STATS_TOKEN and hmac.compare_digest(authorization, ("Bearer " + STATS_TOKEN).encode("utf-8"))
+        ):
+            raise APIException("Forbidden", status_code=403)
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+@app.route("/cache/stats", methods=["GET"])
+@internal_only
+def cache_stats():
+    response_body = {
+        "catalog": catalog_cache.stats(),
+        "catalog_flights": catalog_flights.stats(),
+        "users": user_cache.stats(),
+        "revocations": revocation_list.stats(),
+    }
+    return jsonify(response_body), 200
+
+
+@app.route("/metrics", methods=["GET"])
+@internal_only
+def get_metrics():
+    return app.response_class(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/pool/stats", methods=["GET"])
+@internal_only
+def pool_stats():
+    response_body = pool_metrics.stats()
+    if replica_router is not None:
+        response_body["replicas"] = replica_router.stats()
+    return jsonify(response_body), 200
+
+
+@app.route("/search", methods=["GET"])
+@limiter.limit("list")
+def search():
+    query = request.args.get("q", "").strip()
+    if not query:
+        raise APIException("You need to specify the search text with ?q=", status_code=400)
+    limit = min(request.args.get("limit", 10, type=int), 50)
+    if SEARCH_BACKEND == "postgres" and db.engine.dialect.name == "postgresql":
+        results = postgres_search(db.session, CATALOG_MODELS, query, limit)
+    else:
+        results = search_index.search(query, limit)
+    return jsonify({"q": query, "results": results}), 200
+
+
+# ****************LEADERBOARD********************
+# -----------------------------------------------
+
+
+@app.route("/leaderboard/<any(people, planets, vehicles):kind>", methods=["GET"])
+def get_leaderboard(kind):
+    # the most favorited items, from the counts the favorite handlers maintain
+    top = request.args.get("top", 10, type=int)
+    if not 1 <= top <= leaderboard.size:
+        raise APIException("top must be between 1 and %d" % leaderboard.size, status_code=400)
+    return json_response({"kind": kind, "results": leaderboard.top(kind, top)})
+
+
+# ****************CHANGES********************
+# -------------------------------------------
+
+
+@app.route("/changes", methods=["GET"])
+@jwt_required(optional=True)
+def get_changes():
+    # incremental sync: the catalog (and with a token the user's favorites)
+    # changed after ?since=<version>, start with since=0
+    since = request.args.get("since", type=int)
+    if since is None or since < 0:
+        raise APIException("You need to specify the version of your last sync with ?since=", status_code=400)
+    limit = request.args.get("limit", DEFAULT_CHANGES_LIMIT, type=int)
+    if not 1 <= limit <= MAX_CHANGES_LIMIT:
+        raise APIException("limit must be between 1 and %d" % MAX_CHANGES_LIMIT, status_code=400)
+    user = get_current_user()
+    return json_response(changes_since(db.session, since, user["id"] if user else None, limit))
 
 
 # ****************USERS********************
 # -----------------------------------------
 @app.route("/user", methods=["GET"])
+@jwt_required()
 def get_users():
-    user = User.query.filter().all()
-    result = list(map(lambda user: user.serialize(), user))
+    serializer = row_serializer(User, ["id", "email"])
+    result = serializer.rows(db.session.execute(select(*serializer.columns).order_by(User.id)))
     response_body = {"usuarios": result, "msg": "Ususarios"}
 
-    return jsonify(response_body), 200
+    return json_response(response_body)
 
 
+@app.route("/user/me", methods=["GET"])
 @app.route("/user/<int:user_id>", methods=["GET"])
-def get_user(user_id):
-    user = User.query.get(user_id)
-    return jsonify(user.serialize()), 200
+@jwt_required()
+def get_user(user_id=None):
+    token_user_id(user_id)
+    return jsonify(get_current_user()), 200
 
 
 # ****************PEOPLE********************
@@ -67,16 +450,14 @@ def get_user(user_id):
 
 
 @app.route("/people", methods=["GET"])
+@limiter.limit("list")
 def get_people():
-    people = People.query.filter().all()
-    result = list(map(lambda character: character.serialize(), people))
-    return jsonify(result), 200
+    return catalog_list(People)
 
 
 @app.route("/people/<int:people_id>", methods=["GET"])
 def get_character(people_id):
-    character = People.query.get(people_id)
-    return jsonify(character.serialize()), 200
+    return catalog_item(People, people_id)
 
 
 # ****************PLANETS********************
@@ -84,16 +465,14 @@ def get_character(people_id):
 
 
 @app.route("/planets", methods=["GET"])
+@limiter.limit("list")
 def get_planets():
-    planets = Planets.query.filter().all()
-    result = list(map(lambda planet: planet.serialize(), planets))
-    return jsonify(result), 200
+    return catalog_list(Planets)
 
 
 @app.route("/planets/<int:planet_id>", methods=["GET"])
 def get_planet(planet_id):
-    planet = Planets.query.get(planet_id)
-    return jsonify(planet.serialize()), 200
+    return catalog_item(Planets, planet_id)
 
 
 # ****************VEHICLES********************
@@ -101,31 +480,269 @@ def get_planet(planet_id):
 
 
 @app.route("/vehicles", methods=["GET"])
+@limiter.limit("list")
 def get_vehicles():
-    vehicles = Vehicles.query.filter().all()
-    result = list(map(lambda vehicle: vehicle.serialize(), vehicles))
-    return jsonify(result), 200
+    return catalog_list(Vehicles)
 
 
 @app.route("/vehicles/<int:vehicle_id>", methods=["GET"])
 def get_vehicle(vehicle_id):
-    vehicle = Vehicles.query.get(vehicle_id)
-    return jsonify(vehicle.serialize()), 200
+    return catalog_item(Vehicles, vehicle_id)
+
+
+# ****************EXPORT********************
+# ------------------------------------------
+
+EXPORT_BATCH = 1000
+
+
+def export_chunks(model, array):
+    # Rows are read EXPORT_BATCH at a time by id (WHERE id > the last one sent,
+    # plain tuples, no ORM objects) and every batch is encoded and sent on its
+    # own, so the memory used doesn't depend on the size of the table. Keyset
+    # batches rather than yield_per: most drivers (mysql-connector included)
+    # have no server side cursor and would buffer the whole result.
+    serializer = row_serializer(model)
+    id_position = serializer.names.index("id")
+    statement = select(*serializer.columns).order_by(model.id).limit(EXPORT_BATCH)
+    separator = b",\n" if array else b"\n"
+    first = True
+    if array:
+        yield b"["
+    last_id = None
+    with catalog_reader() as reader:
+        while True:
+            batch = statement if last_id is None else statement.where(model.id > last_id)
+            rows = reader.execute(batch).all()
+            if not rows:
+                break
+            last_id = rows[-1][id_position]
+            chunk = separator.join(dumps(item) for item in serializer.rows(rows))
+            if array:
+                yield chunk if first else separator + chunk
+            else:
+                yield chunk + b"\n"
+            first = False
+            if len(rows) < EXPORT_BATCH:
+                break
+    if array:
+        yield b"]\n"
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+@app.route("/<any(people, planets, vehicles):kind>/export", methods=["GET"])
+@limiter.limit("list")
+def export_catalog(kind):
+    # ?format=ndjson (default, one object per line) or ?format=json (an array),
+    # sent in chunks and gzipped on the fly when the client accepts it
+    export_format = request.args.get("format", "ndjson")
+    if export_format not in ("ndjson", "json"):
+        raise APIException("format must be ndjson or json", status_code=400)
+    chunks = export_chunks(CATALOG_MODELS[kind], array=export_format == "json")
+    headers = {"Vary": "Accept-Encoding"}
+    if request.accept_encodings["gzip"]:
+        chunks = gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+    mimetype = "application/x-ndjson" if export_format == "ndjson" else "application/json"
+    return app.response_class(stream_with_context(chunks), mimetype=mimetype, headers=headers)
 
 
 # ****************FAVORITES********************
 # ---------------------------------------------
 
 
+def catalog_columns(model):
+    # the columns serialize() exposes, without the id
+    return [column for column in exposed_columns(model) if column.name != "id"]
+
+
+def favorites_query(user_id):
+    # One UNION ALL over the three favorites tables joined with their catalog rows.
+    # Catalog columns are cast to text and padded with NULLs so every branch of the
+    # union has the same shape, FAVORITE_KINDS tells us how to read them back.
+    width = max(len(catalog_columns(catalog)) for _, _, catalog in FAVORITE_KINDS.values())
+    selects = []
+    for kind, (favorite, foreign_key, catalog) in FAVORITE_KINDS.items():
+        columns = [cast(column, String) for column in catalog_columns(catalog)]
+        columns += [null()] * (width - len(columns))
+        item_id = getattr(favorite, foreign_key)
+        selects.append(
+            select(
+                literal(kind).label("kind"),
+                favorite.id.label("favorite_id"),
+                item_id.label("item_id"),
+                *[column.label("c%d" % position) for position, column in enumerate(columns)]
+            )
+            .join_from(favorite, catalog, catalog.id == item_id)
+            .where(favorite.user_id == user_id)
+        )
+    return union_all(*selects).order_by("kind", "favorite_id")
+
+
+@app.route("/user/favorites", methods=["GET"])
 @app.route("/user/<int:user_id>/favorites", methods=["GET"])
-def get_favorites(user_id):
-    planets = Favorites_planet.query.filter_by(user_id=user_id).all()
-    people = Favorites_people.query.filter_by(user_id=user_id).all()
-    vehicles = Favorites_vehicles.query.filter_by(user_id=user_id).all()
-    result = (list(map(lambda planet: planet.serialize(), planets)),
-    list(map(lambda character: character.serialize(), people)),
-    list(map(lambda vehicle: vehicle.serialize(), vehicles)))
-    return jsonify(result), 200
+@jwt_required()
+def get_favorites(user_id=None):
+    user_id = token_user_id(user_id)
+    result = {kind: [] for kind in FAVORITE_KINDS}
+    for row in db.session.execute(favorites_query(user_id)):
+        _, foreign_key, catalog = FAVORITE_KINDS[row.kind]
+        item = {"id": row.item_id}
+        for position, column in enumerate(catalog_columns(catalog)):
+            item[column.name] = row[3 + position]
+        result[row.kind].append({"id": row.favorite_id, foreign_key: row.item_id, "item": item})
+    return json_response(result)
+
+
+def favorites_of_kind(favorite, user_id):
+    serializer = row_serializer(favorite)
+    statement = select(*serializer.columns).where(favorite.user_id == user_id).order_by(favorite.id)
+    return serializer.rows(db.session.execute(statement))
+
+
+def require_catalog_item(kind, item_id):
+    # a favorite of a missing item would be counted in favorite_counts (sqlite)
+    # or fail on the foreign key (postgres, mysql)
+    catalog = FAVORITE_KINDS[kind][2]
+    if db.session.execute(select(catalog.id).where(catalog.id == item_id)).first() is None:
+        raise APIException("%s %s not found" % (catalog.__name__, item_id), status_code=404)
+
+
+def remove_favorites(kind, user_id, item_ids):
+    # -> how many were deleted, their tombstones and counts are written too.
+    # The rows are locked first so two concurrent deletes can't both count one.
+    favorite, foreign_key, _ = FAVORITE_KINDS[kind]
+    column = getattr(favorite, foreign_key)
+    rows = db.session.execute(
+        select(favorite.id, column).where(favorite.user_id == user_id, column.in_(item_ids)).with_for_update()
+    ).all()
+    if rows:
+        db.session.execute(delete(favorite).where(favorite.id.in_([row[0] for row in rows])))
+        record_deletes(favorite.__tablename__, [row[0] for row in rows], user_id)
+        count_favorites(kind, [row[1] for row in rows], -1)
+    return len(rows)
+
+
+FAVORITE_OPS = ("add", "remove")
+# one transaction and one IN (...) per kind, kept under SQLite's bound variable limit
+MAX_BATCH_OPERATIONS = 500
+
+
+@app.route("/user/favorites/batch", methods=["POST"])
+@app.route("/user/<int:user_id>/favorites/batch", methods=["POST"])
+@jwt_required()
+def batch_favorites(user_id=None):
+    user_id = token_user_id(user_id)
+    # Body: [{"kind": "people", "id": 1, "op": "add"}, ...] (or {"operations": [...]})
+    # Operations are applied in order with one bulk insert and one bulk delete per
+    # kind and a single commit. Invalid, duplicated or missing items are reported
+    # in the per-item results instead of failing the whole batch.
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        body = body.get("operations")
+    if not isinstance(body, list):
+        raise APIException("You need to specify a list of operations", status_code=400)
+    if len(body) > MAX_BATCH_OPERATIONS:
+        raise APIException("A batch can hold %d operations at most" % MAX_BATCH_OPERATIONS, status_code=400)
+
+    results = []
+    requested = {kind: set() for kind in FAVORITE_KINDS}
+    for operation in body:
+        if not isinstance(operation, dict):
+            operation = {}
+        result = {"kind": operation.get("kind"), "id": operation.get("id"), "op": operation.get("op")}
+        if result["kind"] not in FAVORITE_KINDS or result["op"] not in FAVORITE_OPS \
+                or not isinstance(result["id"], int) or isinstance(result["id"], bool):
+            result["status"] = "invalid"
+        else:
+            requested[result["kind"]].add(result["id"])
+        results.append(result)
+
+    # what is already favorited and what exists in the catalog, one query each per kind
+    favorited, existing = {}, {}
+    for kind, ids in requested.items():
+        if not ids:
+            continue
+        favorite, foreign_key, catalog = FAVORITE_KINDS[kind]
+        column = getattr(favorite, foreign_key)
+        favorited[kind] = set(db.session.execute(
+            select(column).where(favorite.user_id == user_id, column.in_(ids))
+        ).scalars())
+        existing[kind] = set(db.session.execute(
+            select(catalog.id).where(catalog.id.in_(ids))
+        ).scalars())
+
+    inserts = {kind: set() for kind in FAVORITE_KINDS}
+    deletes = {kind: set() for kind in FAVORITE_KINDS}
+    for result in results:
+        if "status" in result:
+            continue
+        kind, item_id = result["kind"], result["id"]
+        if result["op"] == "add":
+            if item_id not in existing[kind]:
+                result["status"] = "not_found"
+            elif item_id in favorited[kind]:
+                result["status"] = "duplicate"
+            else:
+                favorited[kind].add(item_id)
+                if item_id in deletes[kind]:
+                    deletes[kind].discard(item_id)
+                else:
+                    inserts[kind].add(item_id)
+                result["status"] = "added"
+        else:
+            if item_id not in favorited[kind]:
+                result["status"] = "not_found"
+            else:
+                favorited[kind].discard(item_id)
+                if item_id in inserts[kind]:
+                    inserts[kind].discard(item_id)
+                else:
+                    deletes[kind].add(item_id)
+                result["status"] = "removed"
+
+    for kind, (favorite, foreign_key, _) in FAVORITE_KINDS.items():
+        if deletes[kind]:
+            remove_favorites(kind, user_id, deletes[kind])
+        if inserts[kind]:
+            stamp = sync_stamp()
+            db.session.execute(
+                insert_ignore(favorite),
+                [dict(stamp, user_id=user_id, **{foreign_key: item_id}) for item_id in sorted(inserts[kind])],
+            )
+            # a concurrent request may have added some of them first, their insert
+            # was skipped: only the rows carrying this transaction's version count
+            column = getattr(favorite, foreign_key)
+            inserted = set(db.session.execute(
+                select(column).where(
+                    favorite.user_id == user_id, column.in_(inserts[kind]), favorite.version == stamp["version"],
+                )
+            ).scalars())
+            skipped = inserts[kind] - inserted
+            for result in results:
+                if result.get("status") == "added" and result["kind"] == kind and result["id"] in skipped:
+                    result["status"] = "duplicate"
+            inserts[kind] = inserted
+            count_favorites(kind, inserted, 1)
+    db.session.commit()
+    for kind in FAVORITE_KINDS:
+        if inserts[kind] or deletes[kind]:
+            leaderboard.invalidate(kind)
+
+    response_body = {
+        "results": results,
+        "added": sum(len(ids) for ids in inserts.values()),
+        "removed": sum(len(ids) for ids in deletes.values()),
+    }
+    return jsonify(response_body), 200
 
 
 # ****************FAV PEOPLE********************
@@ -133,25 +750,37 @@ def get_favorites(user_id):
 
 
 @app.route("/user/favorites/people", methods=["GET"])
+@jwt_required()
 def get_fav_people():
-    people = Favorites_people.query.filter().all()
-    result = list(map(lambda character: character.serialize(), people))
-    return jsonify(result), 200
+    user_id = token_user_id()
+    return json_response(favorites_of_kind(Favorites_people, user_id))
 
 
+@app.route("/user/favorites/people/<int:people_id>", methods=["POST"])
 @app.route("/user/<int:user_id>/favorites/people/<int:people_id>", methods=["POST"])
-def add_fav_people(user_id, people_id):
-    fav_people = Favorites_people(user_id=int(user_id), people_id=int(people_id))
-    db.session.add(fav_people)
+@jwt_required()
+def add_fav_people(people_id, user_id=None):
+    user_id = token_user_id(user_id)
+    require_catalog_item("people", people_id)
+    added = db.session.execute(insert_ignore(Favorites_people).values(user_id=user_id, people_id=people_id, **sync_stamp())).rowcount
+    if added:
+        count_favorites("people", [people_id], 1)
     db.session.commit()
+    if added:
+        leaderboard.invalidate("people")
     response_body = {"msg": "Favorito agregado"}
     return jsonify(response_body), 200
 
+@app.route("/user/favorites/people/<int:people_id>", methods=["DELETE"])
 @app.route("/user/<int:user_id>/favorites/people/<int:people_id>", methods=["DELETE"])
-def delete_people(user_id, people_id):
-    delete = Favorites_people.query.filter_by(people_id=people_id, user_id=user_id).first()
-    db.session.delete(delete)
-    db.session.commit()        
+@jwt_required()
+def delete_people(people_id, user_id=None):
+    user_id = token_user_id(user_id)
+    deleted = remove_favorites("people", user_id, [people_id])
+    db.session.commit()
+    if not deleted:
+        raise APIException("Favorite not found", status_code=404)
+    leaderboard.invalidate("people")
     return jsonify({"msj": "deleted character"}), 200
 
 
@@ -160,25 +789,37 @@ def delete_people(user_id, people_id):
 
 
 @app.route("/user/favorites/planets", methods=["GET"])
+@jwt_required()
 def get_fav_planet():
-    planets = Favorites_planet.query.filter().all()
-    result = list(map(lambda planet: planet.serialize(), planets))
-    return jsonify(result), 200
+    user_id = token_user_id()
+    return json_response(favorites_of_kind(Favorites_planet, user_id))
 
 
+@app.route("/user/favorites/planets/<int:planet_id>", methods=["POST"])
 @app.route("/user/<int:user_id>/favorites/planets/<int:planet_id>", methods=["POST"])
-def add_fav_planet(user_id, planet_id):
-    fav_planet = Favorites_planet(user_id=int(user_id), planet_id=int(planet_id))
-    db.session.add(fav_planet)
+@jwt_required()
+def add_fav_planet(planet_id, user_id=None):
+    user_id = token_user_id(user_id)
+    require_catalog_item("planets", planet_id)
+    added = db.session.execute(insert_ignore(Favorites_planet).values(user_id=user_id, planet_id=planet_id, **sync_stamp())).rowcount
+    if added:
+        count_favorites("planets", [planet_id], 1)
     db.session.commit()
+    if added:
+        leaderboard.invalidate("planets")
     response_body = {"msg": "Favorito agregado"}
     return jsonify(response_body), 200
 
+@app.route("/user/favorites/planets/<int:planet_id>", methods=["DELETE"])
 @app.route("/user/<int:user_id>/favorites/planets/<int:planet_id>", methods=["DELETE"])
-def delete_planet(user_id, planet_id):
-    delete = Favorites_planet.query.filter_by(planet_id=planet_id, user_id=user_id).first()
-    db.session.delete(delete)
-    db.session.commit()      
+@jwt_required()
+def delete_planet(planet_id, user_id=None):
+    user_id = token_user_id(user_id)
+    deleted = remove_favorites("planets", user_id, [planet_id])
+    db.session.commit()
+    if not deleted:
+        raise APIException("Favorite not found", status_code=404)
+    leaderboard.invalidate("planets")
     return jsonify({"msg":"Deleted planet"}), 200
 
 # ****************FAV VEHICLES********************
@@ -186,28 +827,37 @@ def delete_planet(user_id, planet_id):
 
 
 @app.route("/user/favorites/vehicles", methods=["GET"])
+@jwt_required()
 def get_fav_vehicles():
-    vehicles = Favorites_vehicles.query.filter().all()
-    result = list(map(lambda vehicle: vehicle.serialize(), vehicles))
-    return (
-        jsonify(result),
-        200,
-    )
+    user_id = token_user_id()
+    return json_response(favorites_of_kind(Favorites_vehicles, user_id))
 
 
+@app.route("/user/favorites/vehicles/<int:vehicles_id>", methods=["POST"])
 @app.route("/user/<int:user_id>/favorites/vehicles/<int:vehicles_id>", methods=["POST"])
-def add_fav_vehicle(user_id, vehicles_id):
-    fav_vehicle = Favorites_vehicles(user_id=int(user_id), vehicles_id=int(vehicles_id))
-    db.session.add(fav_vehicle)
+@jwt_required()
+def add_fav_vehicle(vehicles_id, user_id=None):
+    user_id = token_user_id(user_id)
+    require_catalog_item("vehicles", vehicles_id)
+    added = db.session.execute(insert_ignore(Favorites_vehicles).values(user_id=user_id, vehicles_id=vehicles_id, **sync_stamp())).rowcount
+    if added:
+        count_favorites("vehicles", [vehicles_id], 1)
     db.session.commit()
+    if added:
+        leaderboard.invalidate("vehicles")
     response_body = {"msg": "Favorito agregado"}
     return jsonify(response_body), 200
 
+@app.route("/user/favorites/vehicles/<int:vehicles_id>", methods=["DELETE"])
 @app.route("/user/<int:user_id>/favorites/vehicles/<int:vehicles_id>", methods=["DELETE"])
-def delete_vehicle(user_id, vehicles_id):
-    delete = Favorites_vehicles.query.filter_by(vehicles_id=vehicles_id, user_id=user_id).first()
-    db.session.delete(delete)
-    db.session.commit()       
+@jwt_required()
+def delete_vehicle(vehicles_id, user_id=None):
+    user_id = token_user_id(user_id)
+    deleted = remove_favorites("vehicles", user_id, [vehicles_id])
+    db.session.commit()
+    if not deleted:
+        raise APIException("Favorite not found", status_code=404)
+    leaderboard.invalidate("vehicles")
     return jsonify({"msj": "deleted vehicle"}), 200
 
 
@@ -215,18 +865,60 @@ def delete_vehicle(user_id, vehicles_id):
 # ------------------------------------------------
 
 @app.route('/token', methods=['POST'])
+@limiter.limit("token")
 def create_token():
-    email = request.json.get('email', None)
-    password = request.json.get('password', None)
-    user = User.query.filter_by(email=email, password=password).first()
-    if not  user:
-        print(email,password)
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        body = {}
+    email = body.get('email', None)
+    password = body.get('password', None)
+    if not email or not password or not isinstance(email, str) or not isinstance(password, str):
+        raise APIException("You need to specify the email and password", status_code=400)
+
+    throttle_key = (email, request.remote_addr)
+    retry_after = login_throttle.retry_after(throttle_key)
+    if retry_after:
+        response = jsonify({"msg": "Too many failed attempts, try again later"})
+        response.headers["Retry-After"] = str(retry_after)
+        return response, 429
+
+    user = User.query.filter_by(email=email).first()
+    if not verify_password_capped(user.password if user else None, password):
+        login_throttle.failed(throttle_key)
         return jsonify({"msg":"Wrong email or password"}), 401
+    login_throttle.succeeded(throttle_key)
+
+    if needs_rehash(user.password):
+        user.password = hash_password_capped(password)
+        db.session.commit()
 
     acces_token = create_access_token(identity=email)
     return jsonify(acces_token=acces_token)
 
 
+@app.route('/token', methods=['DELETE'])
+@jwt_required()
+def revoke_token():
+    token = get_jwt()
+    revocation_list.revoke(db.session, token["jti"], datetime.utcfromtimestamp(token["exp"]))
+    return jsonify({"msg": "Token revoked"}), 200
+
+
+# every route is registered by now
+with app.test_request_context():
+    SITEMAP_HTML = generate_sitemap(app, admin=ADMIN_MODE != "off").encode("utf-8")
+SITEMAP_ETAG = hashlib.sha1(SITEMAP_HTML).hexdigest()
+HEALTHZ_DB_PING = os.environ.get("HEALTHZ_DB_PING") == "1"
+
+STARTUP = {
+    "imports_seconds": round(IMPORTED_AT - STARTED_AT, 4),
+    "setup_seconds": round(time.perf_counter() - IMPORTED_AT, 4),
+    "total_seconds": round(time.perf_counter() - STARTED_AT, 4),
+}
+metrics.register_stats("startup", lambda: STARTUP)
+app.logger.info("worker ready in %.3fs (imports %.3fs, admin %s)", STARTUP["total_seconds"], STARTUP["imports_seconds"], ADMIN_MODE)
+
+
 # this only runs if `$ python src/main.py` is executed
 if __name__ == "__main__":
     PORT = int(os.environ.get("PORT", 3000))
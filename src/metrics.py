@@ -0,0 +1,171 @@
+"""
+Request and SQL metrics in the Prometheus text format, served on /metrics
+"""
+import threading
+import time
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ['%s="%s"' % (name, str(value).replace("\\", r"\\").replace('"', r"\"")) for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, label_values=(), amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s counter" % self.name]
+        for label_values, value in sorted(self._values.items()):
+            lines.append("%s%s %s" % (self.name, format_labels(self.labels, label_values), value))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, buckets, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.labels = labels
+        # label values -> [count per bucket..., count, sum]
+        self._values = {}
+
+    def observe(self, label_values, value):
+        series = self._values.get(label_values)
+        if series is None:
+            series = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[position] += 1
+        series[-2] += 1
+        series[-1] += value
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s histogram" % self.name]
+        names = self.labels + ("le",)
+        for label_values, series in sorted(self._values.items()):
+            for bound, count in zip(self.buckets, series):
+                lines.append("%s_bucket%s %d" % (self.name, format_labels(names, label_values + (bound,)), count))
+            lines.append("%s_bucket%s %d" % (self.name, format_labels(names, label_values + ("+Inf",)), series[-2]))
+            lines.append("%s_count%s %d" % (self.name, format_labels(self.labels, label_values), series[-2]))
+            lines.append("%s_sum%s %s" % (self.name, format_labels(self.labels, label_values), series[-1]))
+        return lines
+
+
+class Metrics:
+    # Per statement work is two perf_counter() calls and two additions on
+    # flask.g, everything else is recorded once per request under one lock.
+
+    def __init__(self):
+        self.requests = Counter(
+            "http_requests_total", "Requests handled by endpoint, method and status code.",
+            ("endpoint", "method", "status"),
+        )
+        self.latency = Histogram(
+            "http_request_duration_seconds", "Time spent handling a request.",
+            LATENCY_BUCKETS, ("endpoint", "method"),
+        )
+        self.response_size = Histogram(
+            "http_response_size_bytes", "Size of the response bodies.",
+            SIZE_BUCKETS, ("endpoint", "method"),
+        )
+        self.statements = Histogram(
+            "db_statements_per_request", "SQL statements executed while handling a request.",
+            STATEMENT_BUCKETS, ("endpoint", "method"),
+        )
+        self.sql_time = Histogram(
+            "db_time_per_request_seconds", "Time spent in SQL statements while handling a request.",
+            LATENCY_BUCKETS, ("endpoint", "method"),
+        )
+        self._stats = []
+        self._lock = threading.Lock()
+
+    def register_stats(self, prefix, stats):
+        # stats() returns a dict, its numeric values are exposed as gauges
+        self._stats.append((prefix, stats))
+
+    def before_request(self):
+        g.metrics_started_at = time.perf_counter()
+        g.sql_statements = 0
+        g.sql_time = 0.0
+
+    def _record(self, status, size):
+        started_at = g.pop("metrics_started_at", None)
+        if started_at is None:
+            return
+        elapsed = time.perf_counter() - started_at
+        endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        self.observe(
+            endpoint, request.method, status, elapsed, size, g.get("sql_statements", 0), g.get("sql_time", 0.0),
+        )
+
+    def observe(self, endpoint, method, status, elapsed, size=None, statements=None, sql_time=None):
+        # one handled request, also called by the async handlers of asgi.py that
+        # don't go through Flask (they leave the SQL histograms out)
+        labels = (endpoint, method)
+        with self._lock:
+            self.requests.inc(labels + (status,))
+            self.latency.observe(labels, elapsed)
+            if size is not None:
+                self.response_size.observe(labels, size)
+            if statements is not None:
+                self.statements.observe(labels, statements)
+            if sql_time is not None:
+                self.sql_time.observe(labels, sql_time)
+
+    def after_request(self, response):
+        self._record(response.status_code, None if response.is_streamed else response.content_length)
+        return response
+
+    def teardown_request(self, exception):
+        # only still pending when the request failed before a response was made
+        if exception is not None:
+            self._record(500, None)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_started_at", []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get("metrics_started_at")
+        if not started:
+            return
+        elapsed = time.perf_counter() - started.pop()
+        if has_app_context() and "sql_statements" in g:
+            g.sql_statements += 1
+            g.sql_time += elapsed
+
+    def init_app(self, app):
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+        # every engine: the primary, the replicas and the async engine
+        event.listen(Engine, "before_cursor_execute", self.before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", self.after_cursor_execute)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for metric in (self.requests, self.latency, self.response_size, self.statements, self.sql_time):
+                lines.extend(metric.render())
+        for prefix, stats in self._stats:
+            for key, value in sorted(stats().items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    name = "%s_%s" % (prefix, key)
+                    lines.append("# TYPE %s gauge" % name)
+                    lines.append("%s %s" % (name, value))
+        return "\n".join(lines) + "\n"
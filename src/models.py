@@ -1,11 +1,46 @@
+import random
+import re
+from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, insert, select, update
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from passwords import hash_password, is_password_hash
+from replicas import RoutingSession
+
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+NUMBER = re.compile(r"-?\d+(?:\.\d+)?")
+BIRTH_YEAR = re.compile(r"(\d+(?:\.\d+)?)\s*(BBY|ABY)", re.IGNORECASE)
+
+
+def parse_number(raw):
+    # "1,000,000" -> 1000000.0, "1.5 (surface), 1 standard" -> 1.5, "unknown" -> None
+    match = NUMBER.search((raw or "").replace(",", ""))
+    return float(match.group()) if match else None
+
+
+def parse_birth_year(raw):
+    # years are counted from the battle of Yavin: "19BBY" -> -19.0, "4ABY" -> 4.0
+    match = BIRTH_YEAR.search(raw or "")
+    if not match:
+        return None
+    year = float(match.group(1))
+    return -year if match.group(2).upper() == "BBY" else year
+
+class Versioned:
+    # The rows /changes?since= can sync: `version` is the change counter of the
+    # last transaction that wrote the row (see assign_sync_version), deleted rows leave
+    # a Tombstone with the version of their delete.
+    sync_columns = ("version", "updated_at")
+    version = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+    updated_at = db.Column(db.DateTime)
 
-db = SQLAlchemy()
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(120), unique=True, nullable=False)
-    password = db.Column(db.String(80), unique=False, nullable=False)
+    password = db.Column(db.String(255), unique=False, nullable=False)
     name = db.Column(db.String(120), unique=False, nullable=False)
     is_active = db.Column(db.Boolean(), unique=False, nullable=False)
 
@@ -19,14 +54,26 @@ class User(db.Model):
             # do not serialize the password, its a security breach
         }
 
-class Planets(db.Model):
+class Planets(Versioned, db.Model):
+    __table_args__ = (
+        db.Index('ix_planets_version', 'version'),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(120), unique=False, nullable=False)
+    name = db.Column(db.String(120), unique=False, nullable=False, index=True)
     diameter = db.Column(db.String(120), unique=False, nullable=False)
     climate = db.Column(db.String(120), unique=False, nullable=False)
     population = db.Column(db.String(120), unique=False, nullable=False)
     gravity = db.Column(db.String(120), unique=False, nullable=False)
-    
+    diameter_value = db.Column(db.Float, index=True)
+    population_value = db.Column(db.Float, index=True)
+    gravity_value = db.Column(db.Float, index=True)
+
+    # raw string column -> parsed numeric column used for filtering and sorting
+    numeric_fields = {
+        "diameter": "diameter_value",
+        "population": "population_value",
+        "gravity": "gravity_value",
+    }
 
     def serialize(self):
         return {
@@ -39,13 +86,21 @@ class Planets(db.Model):
             # do not serialize the password, its a security breach
         }
 
-class People(db.Model):
+class People(Versioned, db.Model):
+    __table_args__ = (
+        db.Index('ix_people_version', 'version'),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(120), unique=False, nullable=False)
+    name = db.Column(db.String(120), unique=False, nullable=False, index=True)
     gender = db.Column(db.String(120), unique=False, nullable=False)
     skin_color = db.Column(db.String(120), unique=False, nullable=False)
     birth = db.Column(db.String(120), unique=False, nullable=False)
     eyes_color = db.Column(db.String(120), unique=False, nullable=False)
+    birth_value = db.Column(db.Float, index=True)
+
+    numeric_fields = {
+        "birth": "birth_value",
+    }
 
     def serialize(self):
         return {
@@ -58,13 +113,23 @@ class People(db.Model):
         }
 
 
-class Vehicles(db.Model):
+class Vehicles(Versioned, db.Model):
+    __table_args__ = (
+        db.Index('ix_vehicles_version', 'version'),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(120), unique=False, nullable=False)
+    name = db.Column(db.String(120), unique=False, nullable=False, index=True)
     crafter = db.Column(db.String(120), unique=False, nullable=False)
     tripulation = db.Column(db.String(120), unique=False, nullable=False)
     speed = db.Column(db.String(120), unique=False, nullable=False)
     passengers = db.Column(db.String(120), unique=False, nullable=False)
+    speed_value = db.Column(db.Float, index=True)
+    passengers_value = db.Column(db.Float, index=True)
+
+    numeric_fields = {
+        "speed": "speed_value",
+        "passengers": "passengers_value",
+    }
 
     def serialize(self):
         return {
@@ -76,8 +141,12 @@ class Vehicles(db.Model):
             "passengers": self.passengers,
         }
 
-class Favorites_people(db.Model):
+class Favorites_people(Versioned, db.Model):
     __tablename__ = 'people_favorites'
+    __table_args__ = (
+        db.Index('ix_people_favorites_user_id_people_id', 'user_id', 'people_id', unique=True),
+        db.Index('ix_people_favorites_user_id_version', 'user_id', 'version'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     people_id = db.Column(db.Integer, db.ForeignKey('people.id'))
@@ -91,8 +160,12 @@ class Favorites_people(db.Model):
         }
 
 
-class Favorites_planet(db.Model):
+class Favorites_planet(Versioned, db.Model):
     __tablename__ = 'planet_favorites'
+    __table_args__ = (
+        db.Index('ix_planet_favorites_user_id_planet_id', 'user_id', 'planet_id', unique=True),
+        db.Index('ix_planet_favorites_user_id_version', 'user_id', 'version'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     planet_id = db.Column(db.Integer, db.ForeignKey('planets.id'))
@@ -104,8 +177,12 @@ class Favorites_planet(db.Model):
             "planet_id": self.planet_id
         }
 
-class Favorites_vehicles(db.Model):
+class Favorites_vehicles(Versioned, db.Model):
     __tablename__ = 'vehicles_favorites'
+    __table_args__ = (
+        db.Index('ix_vehicles_favorites_user_id_vehicles_id', 'user_id', 'vehicles_id', unique=True),
+        db.Index('ix_vehicles_favorites_user_id_version', 'user_id', 'version'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     vehicles_id = db.Column(db.Integer, db.ForeignKey('vehicles.id'))
@@ -117,3 +194,248 @@ class Favorites_vehicles(db.Model):
             "vehicles_id": self.vehicles_id
             
         }
+
+
+class FavoriteCount(db.Model):
+    # How many users have each catalog item as a favorite, kept up to date by the
+    # favorite handlers so the leaderboard never counts the favorites tables.
+    # The (kind, count, item_id) index gives the top items of a kind in order.
+    __tablename__ = 'favorite_counts'
+    __table_args__ = (
+        db.Index('ix_favorite_counts_kind_item_id', 'kind', 'item_id', unique=True),
+        db.Index('ix_favorite_counts_kind_count', 'kind', 'count', 'item_id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)
+    item_id = db.Column(db.Integer, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    def serialize(self):
+        return {
+            "kind": self.kind,
+            "item_id": self.item_id,
+            "count": self.count,
+        }
+
+
+class Tombstone(db.Model):
+    # a deleted catalog row or favorite, so the clients syncing with /changes
+    # learn about the delete. user_id is set for the favorites.
+    __tablename__ = 'tombstones'
+    id = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String(40), nullable=False)
+    row_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer)
+    version = db.Column(db.BigInteger, nullable=False, index=True)
+    deleted_at = db.Column(db.DateTime, nullable=False)
+
+    def serialize(self):
+        return {
+            "table_name": self.table_name,
+            "row_id": self.row_id,
+            "version": self.version,
+        }
+
+
+class ChangeCounter(db.Model):
+    # a single row, the last version given to a transaction
+    __tablename__ = 'change_counter'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False)
+
+
+class RevokedToken(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    jti = db.Column(db.String(36), unique=True, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def serialize(self):
+        return {
+            "id": self.id,
+            "jti": self.jti,
+            "expires_at": self.expires_at.isoformat(),
+        }
+
+
+# passwords set in plain text (flask-admin, scripts) are hashed before they are stored
+@event.listens_for(User, "before_insert")
+@event.listens_for(User, "before_update")
+def hash_user_password(mapper, connection, target):
+    if not is_password_hash(target.password):
+        target.password = hash_password(target.password)
+
+
+# the numeric columns are derived from the raw strings on every write,
+# whether it comes from the API, flask-admin or a script
+NUMERIC_PARSERS = {"birth": parse_birth_year}
+
+
+@event.listens_for(People, "before_insert")
+@event.listens_for(People, "before_update")
+@event.listens_for(Planets, "before_insert")
+@event.listens_for(Planets, "before_update")
+@event.listens_for(Vehicles, "before_insert")
+@event.listens_for(Vehicles, "before_update")
+def set_numeric_fields(mapper, connection, target):
+    raw = {name: getattr(target, name) for name in target.numeric_fields}
+    for column_name, value in numeric_values(type(target), raw).items():
+        setattr(target, column_name, value)
+
+
+def numeric_values(model, raw):
+    # {"diameter": "10,465", ...} -> {"diameter_value": 10465.0, ...}, also used
+    # by the bulk import, which writes the rows without going through the ORM
+    return {
+        column_name: NUMERIC_PARSERS.get(name, parse_number)(raw.get(name))
+        for name, column_name in model.numeric_fields.items()
+    }
+
+
+# kind (as used in the urls) -> catalog model
+CATALOG_MODELS = {"people": People, "planets": Planets, "vehicles": Vehicles}
+
+# kind (as used in the urls) -> (favorites model, catalog foreign key, catalog model)
+FAVORITE_KINDS = {
+    "people": (Favorites_people, "people_id", People),
+    "planets": (Favorites_planet, "planet_id", Planets),
+    "vehicles": (Favorites_vehicles, "vehicles_id", Vehicles),
+}
+
+# favorites model -> (kind, catalog foreign key)
+FAVORITE_MODEL_KINDS = {favorite: (kind, foreign_key) for kind, (favorite, foreign_key, _) in FAVORITE_KINDS.items()}
+
+
+def insert_ignore(model, dialect=None):
+    # INSERT that silently skips rows hitting a unique index, used for the
+    # favorites so adding the same favorite twice is a cheap no-op
+    dialect = dialect or db.session.get_bind().dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert(model).on_conflict_do_nothing()
+    if dialect == "sqlite":
+        return sqlite.insert(model).on_conflict_do_nothing()
+    if dialect in ("mysql", "mariadb"):
+        return mysql.insert(model).prefix_with("IGNORE")
+    return insert(model)
+
+
+def count_favorites(kind, item_ids, delta, connection=None):
+    # adds `delta` to the favorite counts of the items, in the caller's transaction.
+    # count = count + delta is atomic, concurrent handlers can't lose an update.
+    item_ids = sorted(item_ids)
+    if not item_ids:
+        return
+    # the mapper events pass their connection, the handlers use the session
+    executor = connection if connection is not None else db.session
+    dialect = connection.dialect.name if connection is not None else None
+    if delta > 0:
+        executor.execute(
+            insert_ignore(FavoriteCount, dialect), [{"kind": kind, "item_id": item_id} for item_id in item_ids]
+        )
+    executor.execute(
+        update(FavoriteCount)
+        .where(FavoriteCount.kind == kind, FavoriteCount.item_id.in_(item_ids))
+        .values(count=FavoriteCount.count + delta)
+    )
+
+
+# the API handlers write the favorites with Core statements and count them
+# themselves, these count the ones written through the ORM (flask-admin, scripts)
+@event.listens_for(Favorites_people, "after_insert")
+@event.listens_for(Favorites_planet, "after_insert")
+@event.listens_for(Favorites_vehicles, "after_insert")
+def count_added_favorite(mapper, connection, target):
+    kind, foreign_key = FAVORITE_MODEL_KINDS[type(target)]
+    if getattr(target, foreign_key) is not None:
+        count_favorites(kind, [getattr(target, foreign_key)], 1, connection)
+
+
+@event.listens_for(Favorites_people, "after_delete")
+@event.listens_for(Favorites_planet, "after_delete")
+@event.listens_for(Favorites_vehicles, "after_delete")
+def count_removed_favorite(mapper, connection, target):
+    kind, foreign_key = FAVORITE_MODEL_KINDS[type(target)]
+    if getattr(target, foreign_key) is not None:
+        count_favorites(kind, [getattr(target, foreign_key)], -1, connection)
+
+
+def sync_version(session=None, connection=None):
+    # The version of everything the current transaction writes. Until the commit
+    # it is a placeholder of the transaction, a random negative number /changes
+    # never returns, and nothing is locked.
+    session = session if session is not None else db.session
+    version = session.info.get("sync_version")
+    if version is None:
+        version = session.info["sync_version"] = -random.getrandbits(62) - 1
+    return version
+
+
+@event.listens_for(Session, "before_commit")
+def assign_sync_version(session):
+    # Right before the commit the transaction takes the next value of the change
+    # counter and swaps it for its placeholder (through the version indexes).
+    # The counter row stays locked only from here to the commit, so the versions
+    # are still given in commit order: a client that synced up to a version
+    # can't miss a row committed later with a lower one.
+    if session.in_nested_transaction():
+        # a savepoint released, the version is taken by the outer commit
+        return
+    # the commit flushes after this event, the pending rows need their placeholder now
+    session.flush()
+    placeholder = session.info.get("sync_version")
+    if placeholder is None:
+        return
+    counter = ChangeCounter.__table__
+    bumped = session.execute(update(counter).where(counter.c.id == 1).values(version=counter.c.version + 1))
+    if not bumped.rowcount:
+        session.execute(insert(counter).values(id=1, version=1))
+    version = session.execute(select(counter.c.version).where(counter.c.id == 1)).scalar()
+    for model in VERSIONED_MODELS + (Tombstone,):
+        table = model.__table__
+        session.execute(update(table).where(table.c.version == placeholder).values(version=version))
+    session.info["sync_version"] = version
+
+
+def sync_stamp(session=None, connection=None):
+    # the values of the Versioned columns, for the Core inserts and updates
+    return {"version": sync_version(session, connection), "updated_at": datetime.utcnow()}
+
+
+def record_deletes(table_name, row_ids, user_id=None, connection=None, session=None):
+    # the tombstones of rows deleted in the current transaction
+    if not row_ids:
+        return
+    stamp = sync_stamp(session, connection)
+    executor = connection if connection is not None else db.session
+    executor.execute(insert(Tombstone), [
+        {"table_name": table_name, "row_id": row_id, "user_id": user_id,
+         "version": stamp["version"], "deleted_at": stamp["updated_at"]}
+        for row_id in row_ids
+    ])
+
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_rollback")
+def forget_sync_version(session):
+    session.info.pop("sync_version", None)
+
+
+# the ORM writes (flask-admin, scripts) are stamped here, the API and the bulk
+# import stamp their Core statements with sync_stamp() themselves
+VERSIONED_MODELS = (People, Planets, Vehicles, Favorites_people, Favorites_planet, Favorites_vehicles)
+
+
+def stamp_row(mapper, connection, target):
+    target.version = sync_version(object_session(target), connection)
+    target.updated_at = datetime.utcnow()
+
+
+def record_row_delete(mapper, connection, target):
+    record_deletes(
+        mapper.local_table.name, [target.id], getattr(target, "user_id", None), connection, object_session(target),
+    )
+
+
+for model in VERSIONED_MODELS:
+    event.listen(model, "before_insert", stamp_row)
+    event.listen(model, "before_update", stamp_row)
+    event.listen(model, "after_delete", record_row_delete)
@@ -0,0 +1,116 @@
+"""
+Password hashing with a cap on concurrent hashes, and login throttling
+"""
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# werkzeug method string, the cost is the last part: pbkdf2:sha256:<iterations>
+# or scrypt:<n>:<r>:<p>. Changing it rehashes every password on its next login.
+PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "pbkdf2:sha256:600000")
+HASH_PREFIXES = ("pbkdf2:", "scrypt:")
+
+# At most PASSWORD_HASH_WORKERS hashes run at once per process, the logins
+# past that wait their turn instead of taking every core. The caller still
+# waits for its result: what keeps the worker serving other requests during
+# a login is its threads (gthread, see the Procfile), as hashlib releases the
+# GIL while hashing.
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("PASSWORD_HASH_WORKERS", 4)),
+    thread_name_prefix="password-hash",
+)
+# verified against when the email is unknown so both cases take the same time
+_dummy_hash = None
+
+
+def hash_password(password):
+    return generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+
+
+def is_password_hash(value):
+    return bool(value) and value.startswith(HASH_PREFIXES) and value.count("$") == 2
+
+
+def needs_rehash(value):
+    return not is_password_hash(value) or value.split("$", 1)[0] != PASSWORD_HASH_METHOD
+
+
+def verify_password(stored, password):
+    global _dummy_hash
+    if stored is None:
+        if _dummy_hash is None:
+            _dummy_hash = hash_password("dummy password")
+        check_password_hash(_dummy_hash, password)
+        return False
+    if not is_password_hash(stored):
+        # rows created before passwords were hashed, they get rehashed on login
+        return hmac.compare_digest(stored.encode("utf-8"), password.encode("utf-8"))
+    return check_password_hash(stored, password)
+
+
+def verify_password_capped(stored, password):
+    return _executor.submit(verify_password, stored, password).result()
+
+
+def hash_password_capped(password):
+    return _executor.submit(hash_password, password).result()
+
+
+class LoginThrottle:
+    # Counts the failed logins per key in this process. After `max_attempts`
+    # failures within `window` seconds the key is locked until the window
+    # ends, and locked attempts are rejected before any hashing is done.
+    # The entries are kept in the order their window started, so the expired
+    # ones are dropped from the front and past `max_keys` the oldest goes.
+
+    def __init__(self, max_attempts=5, window=300, max_keys=10000):
+        self.max_attempts = max_attempts
+        self.window = window
+        self.max_keys = max_keys
+        self.rejected = 0
+        self._failures = OrderedDict()
+        self._lock = threading.Lock()
+
+    def retry_after(self, key):
+        # seconds until `key` can try again, 0 if it isn't locked
+        with self._lock:
+            entry = self._failures.get(key)
+            if entry is None:
+                return 0
+            count, started_at = entry
+            remaining = started_at + self.window - time.monotonic()
+            if remaining <= 0:
+                del self._failures[key]
+                return 0
+            if count < self.max_attempts:
+                return 0
+            self.rejected += 1
+            return int(remaining) + 1
+
+    def failed(self, key):
+        with self._lock:
+            now = time.monotonic()
+            count, started_at = self._failures.get(key, (0, now))
+            if started_at + self.window <= now:
+                count, started_at = 0, now
+            self._failures[key] = (count + 1, started_at)
+            if count == 0:
+                self._failures.move_to_end(key)
+            # a flood of random emails can't grow this forever
+            while self._failures:
+                oldest, (_, at) = next(iter(self._failures.items()))
+                if at + self.window > now and len(self._failures) <= self.max_keys:
+                    break
+                del self._failures[oldest]
+
+    def succeeded(self, key):
+        with self._lock:
+            self._failures.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {"rejected": self.rejected, "tracked_keys": len(self._failures)}
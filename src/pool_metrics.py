@@ -0,0 +1,137 @@
+"""
+Connection pool settings from the environment and pool usage metrics
+"""
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+# env var -> (create_engine option, parser). Only the variables that are set are
+# passed, so every database keeps the defaults of its dialect otherwise.
+POOL_SETTINGS = {
+    "DB_POOL_SIZE": ("pool_size", int),
+    "DB_MAX_OVERFLOW": ("max_overflow", int),
+    "DB_POOL_TIMEOUT": ("pool_timeout", float),
+    "DB_POOL_RECYCLE": ("pool_recycle", int),
+    "DB_POOL_PRE_PING": ("pool_pre_ping", lambda value: value.lower() in ("1", "true", "yes")),
+}
+
+
+class TimedQueuePool(QueuePool):
+    # QueuePool that measures how long getting a connection takes, that is the
+    # wait for a free connection plus the time to open a new one when needed
+    metrics = None
+
+    def _do_get(self):
+        started_at = time.perf_counter()
+        try:
+            return super()._do_get()
+        except Exception:
+            if self.metrics is not None:
+                self.metrics.record_checkout_error()
+            raise
+        finally:
+            if self.metrics is not None:
+                self.metrics.record_checkout_wait(time.perf_counter() - started_at)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+
+def engine_options(environ, database_url):
+    options = {
+        option: parse(environ[name])
+        for name, (option, parse) in POOL_SETTINGS.items()
+        if environ.get(name)
+    }
+    # SQLite keeps its own pools, which take none of the QueuePool settings
+    if database_url and make_url(database_url).get_backend_name() != "sqlite":
+        options["poolclass"] = TimedQueuePool
+    return options
+
+
+class PoolMetrics:
+    def __init__(self):
+        self.checkouts = 0
+        self.checkout_errors = 0
+        self.checkout_wait_total = 0.0
+        self.checkout_wait_max = 0.0
+        self.held_total = 0.0
+        self.held_max = 0.0
+        self.connects = 0
+        self.invalidations = 0
+        self.engine = None
+        self._lock = threading.Lock()
+
+    def record_checkout_wait(self, seconds):
+        with self._lock:
+            self.checkout_wait_total += seconds
+            self.checkout_wait_max = max(self.checkout_wait_max, seconds)
+
+    def record_checkout_error(self):
+        with self._lock:
+            self.checkout_errors += 1
+
+    def attach(self, engine):
+        # checkout -> checkin is the time a request (session) held the connection
+        self.engine = engine
+        engine.pool.metrics = self
+
+        @event.listens_for(engine, "connect")
+        def on_connect(dbapi_connection, connection_record):
+            with self._lock:
+                self.connects += 1
+
+        @event.listens_for(engine, "checkout")
+        def on_checkout(dbapi_connection, connection_record, connection_proxy):
+            connection_record.info["checked_out_at"] = time.perf_counter()
+            with self._lock:
+                self.checkouts += 1
+
+        @event.listens_for(engine, "checkin")
+        def on_checkin(dbapi_connection, connection_record):
+            checked_out_at = connection_record.info.pop("checked_out_at", None)
+            if checked_out_at is None:
+                return
+            held = time.perf_counter() - checked_out_at
+            with self._lock:
+                self.held_total += held
+                self.held_max = max(self.held_max, held)
+
+        @event.listens_for(engine, "invalidate")
+        def on_invalidate(dbapi_connection, connection_record, exception):
+            with self._lock:
+                self.invalidations += 1
+
+        @event.listens_for(engine, "soft_invalidate")
+        def on_soft_invalidate(dbapi_connection, connection_record, exception):
+            with self._lock:
+                self.invalidations += 1
+
+    def stats(self):
+        pool = self.engine.pool if self.engine is not None else None
+        with self._lock:
+            result = {
+                "pool": type(pool).__name__,
+                "checkouts": self.checkouts,
+                "checkout_errors": self.checkout_errors,
+                "checkout_wait_total": self.checkout_wait_total,
+                "checkout_wait_max": self.checkout_wait_max,
+                "held_total": self.held_total,
+                "held_max": self.held_max,
+                "connects": self.connects,
+                "invalidations": self.invalidations,
+            }
+        if isinstance(pool, QueuePool):
+            result.update({
+                "size": pool.size(),
+                "checked_in": pool.checkedin(),
+                "checked_out": pool.checkedout(),
+                "overflow": max(pool.overflow(), 0),
+                "max_overflow": pool._max_overflow,
+                "timeout": pool.timeout(),
+            })
+        return result
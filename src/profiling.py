@@ -0,0 +1,156 @@
+"""
+Per request SQL profiling: every statement, N+1 detection and serialization time
+"""
+import functools
+import logging
+import re
+import time
+from collections import Counter
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from serializer import RowSerializer, dumps as encode
+
+PROFILE_HEADER = "X-SQL-Profile"
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+PLACEHOLDER_LIST = re.compile(r"\(\s*(?:\?|%s|%\(\w+\)s|:\w+)(?:\s*,\s*(?:\?|%s|%\(\w+\)s|:\w+))*\s*\)")
+SPACES = re.compile(r"\s+")
+
+
+def statement_shape(statement):
+    # same query with other values -> same shape, "IN (?, ?, ?)" -> "IN (...)"
+    shape = STRING_LITERAL.sub("?", statement)
+    shape = NUMBER_LITERAL.sub("?", shape)
+    shape = PLACEHOLDER_LIST.sub("(...)", shape)
+    return SPACES.sub(" ", shape).strip()
+
+
+class SQLProfiler:
+    # Enabled for every request with SQL_PROFILE=1, or per request with the
+    # X-SQL-Profile: 1 header when SQL_PROFILE_ALLOW_HEADER=1 (the summary shows
+    # query text, keep the header off where clients aren't trusted).
+    # A statement shape repeated `repeat_threshold` times or more in one request
+    # is reported as a N+1 suspect.
+
+    def __init__(self, always=False, allow_header=False, repeat_threshold=3, slowest=3):
+        self.always = always
+        self.allow_header = allow_header
+        self.repeat_threshold = repeat_threshold
+        self.slowest = slowest
+        self.logger = None
+
+    @property
+    def enabled(self):
+        return self.always or self.allow_header
+
+    def before_request(self):
+        if self.always or (self.allow_header and request.headers.get(PROFILE_HEADER) == "1"):
+            g.sql_profile = []
+            g.serialize_profile = []
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("profile_started_at", []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get("profile_started_at")
+        if not started:
+            return
+        elapsed = time.perf_counter() - started.pop()
+        if has_app_context() and g.get("sql_profile") is not None:
+            g.sql_profile.append((statement, elapsed))
+
+    def profile_serialize(self, model):
+        serialize = model.serialize
+
+        @functools.wraps(serialize)
+        def timed_serialize(instance):
+            if not has_app_context() or g.get("serialize_profile") is None:
+                return serialize(instance)
+            started_at = time.perf_counter()
+            try:
+                return serialize(instance)
+            finally:
+                g.serialize_profile.append((model.__name__, 1, time.perf_counter() - started_at))
+
+        model.serialize = timed_serialize
+
+    def profile_row_serializers(self):
+        # the lists and the exports go through RowSerializer, not serialize():
+        # a call is timed as a whole and counts the rows it turned into dicts
+        rows, dumps = RowSerializer.rows, RowSerializer.dumps
+
+        @functools.wraps(rows)
+        def timed_rows(serializer, result):
+            if not has_app_context() or g.get("serialize_profile") is None:
+                return rows(serializer, result)
+            started_at = time.perf_counter()
+            items = rows(serializer, result)
+            g.serialize_profile.append((serializer.model.__name__, len(items), time.perf_counter() - started_at))
+            return items
+
+        @functools.wraps(dumps)
+        def timed_dumps(serializer, result):
+            if not has_app_context() or g.get("serialize_profile") is None:
+                return dumps(serializer, result)
+            started_at = time.perf_counter()
+            items = rows(serializer, result)
+            encoded = encode(items)
+            g.serialize_profile.append((serializer.model.__name__, len(items), time.perf_counter() - started_at))
+            return encoded
+
+        RowSerializer.rows, RowSerializer.dumps = timed_rows, timed_dumps
+
+    def summary(self):
+        statements = g.sql_profile
+        shapes = Counter(statement_shape(statement) for statement, _ in statements)
+        serialized = Counter()
+        serialize_time = Counter()
+        for model_name, count, elapsed in g.serialize_profile:
+            serialized[model_name] += count
+            serialize_time[model_name] += elapsed
+        return {
+            "statements": len(statements),
+            "sql_time": sum(elapsed for _, elapsed in statements),
+            "repeated": [(count, shape) for shape, count in shapes.most_common() if count >= self.repeat_threshold],
+            "slowest": sorted(statements, key=lambda item: item[1], reverse=True)[:self.slowest],
+            "serialize_calls": dict(serialized),
+            "serialize_time": dict(serialize_time),
+        }
+
+    def after_request(self, response):
+        if g.get("sql_profile") is None:
+            return response
+        summary = self.summary()
+        serialize_time = sum(summary["serialize_time"].values())
+        response.headers["X-SQL-Statements"] = str(summary["statements"])
+        response.headers["X-SQL-Time-Ms"] = "%.3f" % (summary["sql_time"] * 1000)
+        response.headers["X-SQL-Repeated"] = str(len(summary["repeated"]))
+        response.headers["X-Serialize-Calls"] = str(sum(summary["serialize_calls"].values()))
+        response.headers["X-Serialize-Time-Ms"] = "%.3f" % (serialize_time * 1000)
+
+        lines = ["sql profile %s %s: %d statements in %.3fms, serialized %s in %.3fms" % (
+            request.method, request.path, summary["statements"], summary["sql_time"] * 1000,
+            summary["serialize_calls"], serialize_time * 1000,
+        )]
+        for count, shape in summary["repeated"]:
+            lines.append("  N+1 suspect, %dx: %s" % (count, shape))
+        for statement, elapsed in summary["slowest"]:
+            lines.append("  slowest %.3fms: %s" % (elapsed * 1000, SPACES.sub(" ", statement)))
+        log = self.logger.warning if summary["repeated"] else self.logger.info
+        log("\n".join(lines))
+        return response
+
+    def init_app(self, app, models=()):
+        if not self.enabled:
+            return
+        self.logger = app.logger
+        if not self.logger.level:
+            self.logger.setLevel(logging.INFO)
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        event.listen(Engine, "before_cursor_execute", self.before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", self.after_cursor_execute)
+        for model in models:
+            self.profile_serialize(model)
+        self.profile_row_serializers()
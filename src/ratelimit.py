@@ -0,0 +1,156 @@
+"""
+Token bucket rate limiting, per JWT identity or per client address
+"""
+import functools
+import math
+import threading
+import time
+from collections import OrderedDict
+from flask import jsonify, request
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class MemoryBackend:
+    # The buckets of this process. With several workers each one has its own,
+    # so a client can get up to workers * burst requests through at once.
+    # Past `max_keys` clients the least recently seen bucket is dropped, the
+    # one most likely to be full again anyway, in constant time per request.
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        # -> (allowed, seconds until a token is available)
+        with self._lock:
+            now = time.monotonic()
+            tokens, updated_at = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return allowed, 0 if allowed else (1 - tokens) / rate
+
+
+class RedisBackend:
+    # Buckets shared by every worker and server, in Redis (needs the redis
+    # package). The refill and the take are one script, so they are atomic.
+    SCRIPT = """
+    local now = redis.call("TIME")
+    now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+    local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+    local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated_at")
+    local tokens = tonumber(bucket[1]) or burst
+    local updated_at = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate)
+    local allowed = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+        allowed = 1
+    end
+    redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "updated_at", tostring(now))
+    redis.call("PEXPIRE", KEYS[1], math.ceil(burst / rate * 1000))
+    return {allowed, tostring(tokens)}
+    """
+
+    def __init__(self, url, prefix="ratelimit:"):
+        if redis is None:
+            raise RuntimeError("RATE_LIMIT_BACKEND=%s needs the redis package" % url)
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url, socket_timeout=0.1)
+        self._script = self._client.register_script(self.SCRIPT)
+
+    def take(self, key, rate, burst):
+        allowed, tokens = self._script(keys=[self.prefix + key], args=[rate, burst])
+        return bool(allowed), 0 if allowed else (1 - float(tokens)) / rate
+
+
+def rate_limit_backend(url):
+    # "memory" or a redis:// url
+    if not url or url == "memory":
+        return MemoryBackend()
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackend(url)
+    raise ValueError("Unknown rate limit backend: %s" % url)
+
+
+class RateLimiter:
+    # `limits` is {name: (rate, burst)}: every client has a bucket of `burst`
+    # requests per limit, refilled with `rate` requests per second. A rate of 0
+    # turns the limit off. Clients are told apart by their JWT identity, or by
+    # their address when the request has no valid token. If the backend fails
+    # the request is let through (and counted in backend_errors).
+    #
+    #   @app.route("/token", methods=["POST"])
+    #   @limiter.limit("token")
+
+    def __init__(self, backend, limits):
+        self.backend = backend
+        self.limits = limits
+        self.allowed = dict.fromkeys(limits, 0)
+        self.rejected = dict.fromkeys(limits, 0)
+        self.backend_errors = 0
+        self._lock = threading.Lock()
+
+    def _count(self, counter, name=None):
+        # the gthread workers run requests in parallel, += alone could lose some
+        with self._lock:
+            if name is None:
+                self.backend_errors += 1
+            else:
+                counter[name] += 1
+
+    def client_key(self):
+        try:
+            verify_jwt_in_request(optional=True)
+            identity = get_jwt_identity()
+        except Exception:
+            identity = None
+        if identity is not None:
+            return "user:%s" % identity
+        return "ip:%s" % request.remote_addr
+
+    def limit(self, name):
+        rate, burst = self.limits[name]
+
+        def decorator(view):
+            if rate <= 0:
+                return view
+
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                try:
+                    allowed, retry_after = self.backend.take("%s:%s" % (name, self.client_key()), rate, burst)
+                except Exception:
+                    self._count(None)
+                    allowed = True
+                if allowed:
+                    self._count(self.allowed, name)
+                    return view(*args, **kwargs)
+                self._count(self.rejected, name)
+                response = jsonify({"msg": "Too many requests, try again later"})
+                response.headers["Retry-After"] = str(max(1, int(math.ceil(retry_after))))
+                response.headers["X-RateLimit-Limit"] = str(burst)
+                return response, 429
+
+            return wrapper
+
+        return decorator
+
+    def stats(self):
+        with self._lock:
+            stats = {"backend_errors": self.backend_errors}
+            for name in self.limits:
+                stats["%s_allowed" % name] = self.allowed[name]
+                stats["%s_rejected" % name] = self.rejected[name]
+        return stats
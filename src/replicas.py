@@ -0,0 +1,156 @@
+"""
+Routes the reads of GET requests to read replicas
+"""
+import itertools
+import threading
+import time
+from flask import g, has_app_context, request
+from flask_jwt_extended import decode_token
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event
+
+PIN_COOKIE = "db_primary_until"
+
+
+class RoutingSession(Session):
+    # Uses the replica picked for the current request, if any. Flushes (and a
+    # session holding pending changes) always go to the primary.
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_app_context() and not self._flushing and not (self.new or self.dirty or self.deleted):
+            replica = g.get("db_replica")
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class ReplicaRouter:
+    # GET and HEAD requests read from the replicas in round-robin, every other
+    # method (the favorites writes, /token) and /admin use the primary.
+    #
+    # A replica that fails its health check or with a disconnect is skipped for
+    # `retry_after` seconds. When none is available the primary is used.
+    #
+    # Read-your-writes: after a successful write the user's reads stay on the
+    # primary for `pin_seconds`. The pin is kept in this process by token
+    # identity and in a cookie, so other workers honour it too.
+
+    def __init__(self, urls, engine_options=None, retry_after=30, pin_seconds=5, check_interval=5):
+        # engine_options(url) returns the create_engine() options of a replica
+        self.engines = [
+            create_engine(url, **dict(engine_options(url) if engine_options else {}, pool_pre_ping=True))
+            for url in urls
+        ]
+        self.retry_after = retry_after
+        self.check_interval = check_interval
+        self.pin_seconds = pin_seconds
+        self.replica_reads = 0
+        self.primary_reads = 0
+        self.failures = 0
+        self._next = itertools.count()
+        self._down_until = {}
+        self._checked_at = {}
+        self._pinned = {}
+        self._lock = threading.Lock()
+        for engine in self.engines:
+            event.listen(engine, "handle_error", self._on_error(engine))
+
+    def _on_error(self, engine):
+        def on_error(context):
+            if context.is_disconnect:
+                with self._lock:
+                    self.failures += 1
+                    self._down_until[engine] = time.monotonic() + self.retry_after
+        return on_error
+
+    def _healthy(self, engine):
+        # a replica that wasn't used for `check_interval` seconds is pinged
+        # before it gets a request, that finds the dead ones before a user does
+        now = time.monotonic()
+        with self._lock:
+            if self._down_until.get(engine, 0) > now:
+                return False
+            if now - self._checked_at.get(engine, 0) < self.check_interval:
+                return True
+            self._checked_at[engine] = now
+        try:
+            with engine.connect() as connection:
+                connection.exec_driver_sql("SELECT 1")
+        except Exception:
+            with self._lock:
+                self.failures += 1
+                self._down_until[engine] = time.monotonic() + self.retry_after
+            return False
+        return True
+
+    def pick(self):
+        for _ in range(len(self.engines)):
+            with self._lock:
+                engine = self.engines[next(self._next) % len(self.engines)]
+            if self._healthy(engine):
+                return engine
+        return None
+
+    def _identity(self):
+        authorization = request.headers.get("Authorization", "")
+        if not authorization.startswith("Bearer "):
+            return None
+        try:
+            return decode_token(authorization[len("Bearer "):], allow_expired=True)["sub"]
+        except Exception:
+            return None
+
+    def _is_pinned(self):
+        now = time.time()
+        try:
+            pinned_until = float(request.cookies.get(PIN_COOKIE, 0) or 0)
+        except ValueError:
+            pinned_until = 0
+        # the cookie comes from the client: a pin never lasts longer than
+        # `pin_seconds` from now, whatever time it says
+        if now < pinned_until and pinned_until - now <= self.pin_seconds:
+            return True
+        if not self._pinned:
+            return False
+        return self._pinned.get(self._identity(), 0) > now
+
+    def before_request(self):
+        g.db_replica = None
+        if request.method not in ("GET", "HEAD") or request.path.startswith("/admin"):
+            return
+        if not self._is_pinned():
+            g.db_replica = self.pick()
+        with self._lock:
+            if g.db_replica is None:
+                self.primary_reads += 1
+            else:
+                self.replica_reads += 1
+
+    def after_request(self, response):
+        if request.method in ("GET", "HEAD", "OPTIONS") or response.status_code >= 400:
+            return response
+        until = time.time() + self.pin_seconds
+        identity = self._identity()
+        if identity is not None:
+            with self._lock:
+                self._pinned[identity] = until
+                # drop the pins that are over so the dict stays small
+                if len(self._pinned) > 10000:
+                    now = time.time()
+                    self._pinned = {key: value for key, value in self._pinned.items() if value > now}
+        response.set_cookie(PIN_COOKIE, "%.3f" % until, max_age=max(int(self.pin_seconds), 1), httponly=True)
+        return response
+
+    def init_app(self, app):
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "replicas": len(self.engines),
+                "healthy": sum(1 for engine in self.engines if self._down_until.get(engine, 0) <= now),
+                "replica_reads": self.replica_reads,
+                "primary_reads": self.primary_reads,
+                "failures": self.failures,
+            }
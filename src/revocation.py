@@ -0,0 +1,103 @@
+"""
+Revoked JWT list, checked through an in-memory bloom filter
+"""
+import hashlib
+import math
+import threading
+import time
+from datetime import datetime
+
+
+class BloomFilter:
+    def __init__(self, capacity=100000, error_rate=0.01):
+        self.capacity = capacity
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # double hashing: the k positions are h1 + i * h2 over one blake2b digest
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class RevocationList:
+    # The revoked tokens live in the database (`model`, with id, jti and
+    # expires_at columns) so every worker sees them. Each worker keeps a bloom
+    # filter of the jtis: a token that isn't in the filter (nearly every request)
+    # is accepted without a query, a filter hit is confirmed in the database.
+    # New rows from the other workers are pulled every `refresh` seconds: a
+    # token revoked on another worker is still accepted here for up to that
+    # long. With refresh=0 the new rows are pulled on every check, one indexed
+    # query that finds nothing new nearly every time.
+    #
+    # Ids don't become visible in order: with concurrent revokes a lower id can
+    # commit after a higher one was read. Each pull reads the last `overlap` ids
+    # again, so a late row is still picked up by the next pull.
+
+    def __init__(self, model, refresh=5, capacity=100000, error_rate=0.01, overlap=1000):
+        self.model = model
+        self.refresh = refresh
+        self.overlap = overlap
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.checks = 0
+        self.lookups = 0
+        self._bloom = BloomFilter(capacity, error_rate)
+        self._last_id = 0
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        model = self.model
+        with self._lock:
+            if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.refresh:
+                return
+            if self._bloom.count > self.capacity:
+                # too many entries for the filter, start over without the expired tokens
+                self._bloom = BloomFilter(self.capacity, self.error_rate)
+                self._last_id = 0
+            query = model.query.with_entities(model.id, model.jti).filter(model.id > self._last_id - self.overlap)
+            if self._last_id == 0:
+                query = query.filter(model.expires_at > datetime.utcnow())
+            for row_id, jti in query.order_by(model.id):
+                # the rows read again are already in, they don't count twice
+                if jti not in self._bloom:
+                    self._bloom.add(jti)
+                self._last_id = max(self._last_id, row_id)
+            self._loaded_at = time.monotonic()
+
+    def revoke(self, session, jti, expires_at):
+        session.add(self.model(jti=jti, expires_at=expires_at))
+        session.query(self.model).filter(self.model.expires_at <= datetime.utcnow()).delete()
+        session.commit()
+        with self._lock:
+            self._bloom.add(jti)
+
+    def is_revoked(self, jti):
+        self._load()
+        self.checks += 1
+        if jti not in self._bloom:
+            return False
+        self.lookups += 1
+        return self.model.query.filter_by(jti=jti).first() is not None
+
+    def stats(self):
+        return {
+            "checks": self.checks,
+            "lookups": self.lookups,
+            "filter_entries": self._bloom.count,
+            "filter_bits": self._bloom.size,
+            "filter_hashes": self._bloom.hashes,
+        }
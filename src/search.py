@@ -0,0 +1,158 @@
+"""
+Typeahead search over the People, Planets and Vehicles names
+"""
+import re
+import threading
+import time
+from bisect import bisect_left, insort
+from sqlalchemy import desc, event, func, literal, select, union_all
+
+WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text):
+    return WORD.findall((text or "").lower())
+
+
+class NameIndex:
+    # Every word of every name is kept in one sorted list of (word, kind, id),
+    # a prefix lookup is two bisects plus a scan over the matching slice.
+    # The index is built on the first search and kept up to date by the mapper
+    # events of this process, writes from other workers show up after `ttl`
+    # seconds when the index is rebuilt.
+
+    def __init__(self, models, ttl=300):
+        self.models = models
+        self.ttl = ttl
+        self._words = []
+        self._names = {}
+        self._built_at = None
+        # the changes seen while a build reads the tables, replayed on its result
+        self._pending = None
+        self._lock = threading.RLock()
+        self._build_lock = threading.Lock()
+
+    def build(self):
+        with self._lock:
+            self._pending = []
+        try:
+            words, names = [], {}
+            for kind, model in self.models.items():
+                for item_id, name in model.query.with_entities(model.id, model.name):
+                    names[(kind, item_id)] = name
+                    words.extend((word, kind, item_id) for word in tokenize(name))
+            words.sort()
+            with self._lock:
+                for kind, item_id, name in self._pending:
+                    self._remove(words, names, kind, item_id)
+                    if name is not None:
+                        self._add(words, names, kind, item_id, name)
+                self._words = words
+                self._names = names
+                self._built_at = time.monotonic()
+        finally:
+            with self._lock:
+                self._pending = None
+
+    def _ensure_built(self):
+        # one build at a time: the first search waits for it, once there is an
+        # index the other searches keep using the old one during a rebuild
+        if self._built_at is not None and time.monotonic() - self._built_at <= self.ttl:
+            return
+        if not self._build_lock.acquire(blocking=self._built_at is None):
+            return
+        try:
+            if self._built_at is None or time.monotonic() - self._built_at > self.ttl:
+                self.build()
+        finally:
+            self._build_lock.release()
+
+    def add(self, kind, item_id, name):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((kind, item_id, name))
+            if self._built_at is None:
+                return
+            self._remove(self._words, self._names, kind, item_id)
+            self._add(self._words, self._names, kind, item_id, name)
+
+    def remove(self, kind, item_id):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((kind, item_id, None))
+            if self._built_at is not None:
+                self._remove(self._words, self._names, kind, item_id)
+
+    @staticmethod
+    def _add(words, names, kind, item_id, name):
+        names[(kind, item_id)] = name
+        for word in tokenize(name):
+            insort(words, (word, kind, item_id))
+
+    @staticmethod
+    def _remove(words, names, kind, item_id):
+        name = names.pop((kind, item_id), None)
+        for word in set(tokenize(name)):
+            position = bisect_left(words, (word, kind, item_id))
+            while position < len(words) and words[position] == (word, kind, item_id):
+                del words[position]
+
+    def _prefix_range(self, prefix):
+        # every word starting with `prefix` sorts between (prefix,) and (prefix + max char,)
+        return (
+            bisect_left(self._words, (prefix,)),
+            bisect_left(self._words, (prefix + "\U0010ffff",)),
+        )
+
+    def search(self, query, limit=10):
+        prefixes = tokenize(query)
+        if not prefixes:
+            return []
+        self._ensure_built()
+        with self._lock:
+            # scan the narrowest prefix and check the others against the whole name
+            ranges = sorted((self._prefix_range(prefix) for prefix in prefixes), key=lambda r: r[1] - r[0])
+            start, end = ranges[0]
+            results, seen = [], set()
+            for _, kind, item_id in self._words[start:end]:
+                if (kind, item_id) in seen:
+                    continue
+                seen.add((kind, item_id))
+                name = self._names[(kind, item_id)]
+                words = tokenize(name)
+                if all(any(word.startswith(prefix) for word in words) for prefix in prefixes):
+                    results.append({"kind": kind, "id": item_id, "name": name})
+                    if len(results) >= limit:
+                        break
+            return results
+
+    def listen(self):
+        def on_save(kind):
+            return lambda mapper, connection, target: self.add(kind, target.id, target.name)
+
+        def on_delete(kind):
+            return lambda mapper, connection, target: self.remove(kind, target.id)
+
+        for kind, model in self.models.items():
+            event.listen(model, "after_insert", on_save(kind))
+            event.listen(model, "after_update", on_save(kind))
+            event.listen(model, "after_delete", on_delete(kind))
+
+
+def postgres_search(session, models, query, limit=10):
+    # Trigram search, needs the pg_trgm extension and the gin indexes created by
+    # the 0d5e2b7a9c14 migration. Results are ranked by similarity to the query.
+    selects = [
+        select(
+            literal(kind).label("kind"),
+            model.id.label("id"),
+            model.name.label("name"),
+            func.similarity(model.name, query).label("rank"),
+        ).where(model.name.ilike("%" + query.replace("%", r"\%").replace("_", r"\_") + "%"))
+        for kind, model in models.items()
+    ]
+    statement = union_all(*selects).order_by(desc("rank"), "name").limit(limit)
+    return [
+        {"kind": row.kind, "id": row.id, "name": row.name}
+        for row in session.execute(statement)
+    ]
@@ -0,0 +1,178 @@
+"""
+Read-only catalog snapshots: People, Planets and Vehicles in a SQLite file, read through mmap
+"""
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+from urllib.parse import quote
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import Column, MetaData, String, Table, create_engine, event, insert, select
+from sqlalchemy.pool import QueuePool
+from changes import current_version
+from models import db, CATALOG_MODELS
+
+# what the snapshot was made from, next to the catalog tables
+SNAPSHOT_META = Table(
+    "snapshot_meta", MetaData(),
+    Column("key", String(40), primary_key=True),
+    Column("value", String(255), nullable=False),
+)
+
+
+def write_snapshot(session, path, batch_size=5000):
+    # The file is written next to `path` and moved over it once complete, a
+    # server reading the old file sees either the old or the new snapshot.
+    # -> {kind: rows}
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temporary = tempfile.mkstemp(prefix=".snapshot-", suffix=".db", dir=directory)
+    os.close(handle)
+    try:
+        engine = create_engine("sqlite:///" + temporary)
+
+        @event.listens_for(engine, "connect")
+        def fast_writes(dbapi_connection, connection_record):
+            # a half written file is thrown away, it doesn't need a journal
+            dbapi_connection.execute("PRAGMA journal_mode=OFF")
+            dbapi_connection.execute("PRAGMA synchronous=OFF")
+
+        tables = [model.__table__ for model in CATALOG_MODELS.values()]
+        db.metadata.create_all(engine, tables=tables)
+        SNAPSHOT_META.create(engine)
+        counts = {}
+        with engine.begin() as connection:
+            for kind, model in CATALOG_MODELS.items():
+                table = model.__table__
+                counts[kind] = 0
+                result = session.execute(select(table).order_by(table.c.id).execution_options(yield_per=batch_size))
+                for rows in result.partitions():
+                    connection.execute(insert(table), [dict(row._mapping) for row in rows])
+                    counts[kind] += len(rows)
+            meta = dict(
+                {"rows_%s" % kind: count for kind, count in counts.items()},
+                version=current_version(session),
+                created_at=datetime.utcnow().isoformat(),
+            )
+            connection.execute(insert(SNAPSHOT_META), [{"key": key, "value": str(value)} for key, value in meta.items()])
+        engine.dispose()
+
+        # statistics for the query planner, then the file packed as tight as it goes
+        connection = sqlite3.connect(temporary, isolation_level=None)
+        try:
+            connection.execute("ANALYZE")
+            connection.execute("VACUUM")
+        finally:
+            connection.close()
+        with open(temporary, "rb+") as file:
+            os.fsync(file.fileno())
+        os.chmod(temporary, 0o644)
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+    return counts
+
+
+class CatalogSnapshot:
+    # Serves the catalog reads from a snapshot file. It is opened read-only and
+    # immutable (no locking, no journal checks) and memory mapped whole, so every
+    # gunicorn worker shares the same pages of the OS page cache and a read never
+    # leaves the machine.
+    #
+    # The file is stat()ed at most every `check_interval` seconds, call check()
+    # before serving from a cache built from it. A new snapshot moved in place
+    # (a new inode) is opened and swapped in for the next reads, the reads
+    # running on the old one finish on it. The `on_reload` callbacks run after
+    # a swap. A snapshot that fails to open is skipped, the old one is kept.
+
+    def __init__(self, path, check_interval=1, on_reload=()):
+        self.path = os.path.abspath(path)
+        self.check_interval = check_interval
+        self.on_reload = list(on_reload)
+        self.reloads = 0
+        self.errors = 0
+        self.info = {}
+        self._engine = None
+        self._identity = None
+        self._checked_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._open(self._stat())
+
+    def _stat(self):
+        stat = os.stat(self.path)
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _open(self, identity):
+        uri = "file:%s?mode=ro&immutable=1" % quote(self.path)
+        size = identity[2]
+
+        def connect():
+            connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            connection.execute("PRAGMA mmap_size=%d" % size)
+            return connection
+
+        engine = create_engine("sqlite://", creator=connect, poolclass=QueuePool)
+        with engine.connect() as connection:
+            info = dict(connection.execute(select(SNAPSHOT_META.c.key, SNAPSHOT_META.c.value)).all())
+        previous = self._engine
+        self._engine, self._identity, self.info = engine, identity, info
+        if previous is not None:
+            # the connections in use are closed when they are given back
+            previous.dispose()
+
+    def check(self):
+        # cheap enough for every request, the cached responses included
+        if time.monotonic() - self._checked_at >= self.check_interval:
+            with self._lock:
+                if time.monotonic() - self._checked_at >= self.check_interval:
+                    self._checked_at = time.monotonic()
+                    self._reload()
+
+    def engine(self):
+        self.check()
+        return self._engine
+
+    def _reload(self):
+        try:
+            identity = self._stat()
+            if identity == self._identity:
+                return
+            self._open(identity)
+        except Exception:
+            self.errors += 1
+            return
+        self.reloads += 1
+        for callback in self.on_reload:
+            callback()
+
+    def connect(self):
+        return self.engine().connect()
+
+    def stats(self):
+        return {
+            "version": int(self.info.get("version", 0)),
+            "size_bytes": self._identity[2],
+            "reloads": self.reloads,
+            "errors": self.errors,
+        }
+
+
+@click.command("export-snapshot")
+@click.argument("path", type=click.Path(dir_okay=False))
+@click.option("--batch-size", default=5000, show_default=True, help="Rows read and written at a time.")
+@with_appcontext
+def export_snapshot(path, batch_size):
+    """Write People, Planets and Vehicles to a SQLite snapshot file.
+
+    The file replaces PATH atomically. Servers started with
+    CATALOG_SNAPSHOT=PATH pick it up within SNAPSHOT_CHECK_SECONDS.
+    """
+    started_at = time.perf_counter()
+    counts = write_snapshot(db.session, path, batch_size)
+    click.echo("%s: %s rows in %.1fs, %d bytes" % (
+        path, ", ".join("%d %s" % (count, kind) for kind, count in counts.items()),
+        time.perf_counter() - started_at, os.path.getsize(path),
+    ), err=True)
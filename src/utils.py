@@ -1,4 +1,6 @@
 from flask import jsonify, url_for
+from sqlalchemy import select
+from serializer import exposed_columns, row_serializer
 
 class APIException(Exception):
     status_code = 400
@@ -15,13 +17,143 @@ class APIException(Exception):
         rv['message'] = self.message
         return rv
 
+DEFAULT_PAGE_LIMIT = 50
+MAX_PAGE_LIMIT = 500
+
+def parse_fields(model, raw_fields):
+    # ?fields=name,gender -> column names to load, the id is always included
+    # because it is the pagination cursor
+    if not raw_fields:
+        return None
+    # only what serialize() exposes, and each field once: the serializers are
+    # cached per set of fields
+    columns = {column.name for column in exposed_columns(model)}
+    fields = list(dict.fromkeys(field.strip() for field in raw_fields.split(",") if field.strip()))
+    unknown = [field for field in fields if field not in columns]
+    if unknown:
+        raise APIException("Unknown fields: " + ", ".join(unknown), status_code=400)
+    if "id" not in fields:
+        fields.insert(0, "id")
+    return fields
+
+def parse_limit(raw_limit):
+    if raw_limit is None:
+        return DEFAULT_PAGE_LIMIT
+    try:
+        limit = int(raw_limit)
+    except ValueError:
+        raise APIException("limit must be an integer", status_code=400)
+    if limit < 1:
+        raise APIException("limit must be greater than 0", status_code=400)
+    return min(limit, MAX_PAGE_LIMIT)
+
+def parse_number(args, name):
+    raw = args.get(name)
+    if raw is None:
+        return None
+    try:
+        return float(raw)
+    except ValueError:
+        raise APIException(name + " must be a number", status_code=400)
+
+def parse_sort(model, raw_sort):
+    # ?sort=population or ?sort=-speed, only the numeric columns (and id) are sortable
+    numeric_fields = getattr(model, "numeric_fields", {})
+    if not raw_sort or raw_sort.lstrip("-") == "id":
+        return None, raw_sort == "-id"
+    name = raw_sort.lstrip("-")
+    if name not in numeric_fields:
+        sortable = ", ".join(["id"] + sorted(numeric_fields))
+        raise APIException("Can't sort by " + name + ", use one of: " + sortable, status_code=400)
+    return numeric_fields[name], raw_sort.startswith("-")
+
+def parse_cursor(raw_after, sort_column):
+    # without a sort the cursor is the last id, with one it is "<value>:<id>"
+    # and the value is left empty for the rows where it is unknown (NULL)
+    if raw_after is None:
+        return None
+    try:
+        if sort_column is None:
+            return None, int(raw_after)
+        value, _, last_id = raw_after.rpartition(":")
+        return (float(value) if value else None), int(last_id)
+    except ValueError:
+        raise APIException("Invalid after cursor", status_code=400)
+
+def paginate(model, args, session=None):
+    # Keyset pagination: ?after=<cursor>&limit=N&fields=a,b
+    # Numeric filters and sorting: ?min_population=1000&max_diameter=5000&sort=-population
+    # The whole table is only returned when the client asks for it with ?all=true
+    fields = parse_fields(model, args.get("fields"))
+    numeric_fields = getattr(model, "numeric_fields", {})
+    sort_name, descending = parse_sort(model, args.get("sort"))
+    sort_column = getattr(model, sort_name) if sort_name else None
+
+    # plain row tuples, the serializer writes them without building ORM objects
+    serializer = row_serializer(model, fields)
+    columns = serializer.columns
+    if sort_name and sort_name not in serializer.names:
+        columns = columns + [sort_column]
+    query = select(*columns)
+
+    for name, column_name in numeric_fields.items():
+        column = getattr(model, column_name)
+        minimum = parse_number(args, "min_" + name)
+        maximum = parse_number(args, "max_" + name)
+        if minimum is not None:
+            query = query.filter(column >= minimum)
+        if maximum is not None:
+            query = query.filter(column <= maximum)
+
+    cursor = parse_cursor(args.get("after"), sort_column)
+    if sort_column is None:
+        if cursor is not None:
+            query = query.filter(model.id < cursor[1] if descending else model.id > cursor[1])
+        query = query.order_by(model.id.desc() if descending else model.id)
+    else:
+        # unknown values (NULL) go last in both directions, ties are broken by id
+        if cursor is not None:
+            value, last_id = cursor
+            if value is None:
+                query = query.filter(sort_column.is_(None), model.id > last_id)
+            else:
+                past_value = sort_column < value if descending else sort_column > value
+                query = query.filter(
+                    past_value
+                    | ((sort_column == value) & (model.id > last_id))
+                    | sort_column.is_(None)
+                )
+        query = query.order_by(
+            sort_column.is_(None), sort_column.desc() if descending else sort_column, model.id
+        )
+
+    limit = None
+    if args.get("all", "").lower() not in ("1", "true", "yes"):
+        limit = parse_limit(args.get("limit"))
+        # fetch one extra row to know if there is a next page
+        query = query.limit(limit + 1)
+    # `session`: a session or connection to read from, the model's by default
+    rows = (session if session is not None else model.query.session).execute(query).all()
+
+    next_after = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        if sort_column is None:
+            next_after = last.id
+        else:
+            value = getattr(last, sort_name)
+            next_after = "%s:%d" % ("" if value is None else repr(value), last.id)
+
+    return serializer.rows(rows), next_after
+
 def has_no_empty_params(rule):
     defaults = rule.defaults if rule.defaults is not None else ()
     arguments = rule.arguments if rule.arguments is not None else ()
     return len(defaults) >= len(arguments)
 
-def generate_sitemap(app):
-    links = ['/admin/']
+def generate_sitemap(app, admin=True):
+    links = ['/admin/'] if admin else []
     for rule in app.url_map.iter_rules():
         # Filter out rules we can't navigate to in a browser
         # and rules that require parameters